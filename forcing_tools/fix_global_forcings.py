@@ -1,35 +1,149 @@
 #!/usr/local/bin/python
 
 import numpy as np
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 import glob
 import os
 import sys
 import time as tm
-from cdo import *
-cdo = Cdo()
+import multiprocessing
+from regrid import read_domain, get_weights, remap
 
 grid = '/raid/jhamman/RASM_masks/domain.lnd.wr50a_ar9v4.100920.nc'
 inpath = '/raid/jhamman/raw_forcings/Adam2006/Global/all/'
 outpath = '/raid/jhamman/RASM_met_forcings/Adam2006_Global/'
-tempfile = 'temp.nc'
+# remapping weights are cached here (computed once per source/target grid)
+weightpath = outpath
+# number of files processed at the same time
+numofproc = multiprocessing.cpu_count()
+# (input name, output name) of the forcing variables
+forcing_vars = (('Prec','Precip'),('Tmax','Tmax'),('Tmin','Tmin'),('Wind','Wind'))
+methods = (('bilinear','_RASM_BIL.nc'),('conservative','_RASM_CON.nc'))
+res = 0.5
+# number of time steps read and written at a time
+timechunk = 365
+# dtype of the remapped variables (None keeps the dtype and packing of the source)
+dtype = None
+# zlib compression level of the outputs
+complevel = 4
+# attributes that describe the stored values of a variable
+packing_attrs = ('scale_factor','add_offset','missing_value','valid_range','valid_min','valid_max')
 
 def main():
     os.chdir(inpath)
     files = glob.glob("*nc")
-    for i,infile in enumerate(files):
-        fix_netcdf(infile,tempfile)
-        
-        outfile1 = outpath+infile[:-3]+'_RASM_BIL.nc'
-        outfile2 = outpath+infile[:-3]+'_RASM_CON.nc'
+    domain = read_domain(grid)
 
-        print 'trying input:', infile,tempfile, 'output:', outfile1,outfile2
-        cdo.remapbil(grid,input = tempfile,output = outfile1)
+    # compute (and cache) the weights once, before the workers need them
+    lat, lon = fixed_coords(files[0])
+    for method, suffix in methods:
+        get_weights(method,lat,lon,domain,cache_dir=weightpath)
 
-        cdo.remapbil(grid,input = tempfile,output = outfile2)
+    pool = multiprocessing.Pool(processes=numofproc)
+    tasks = [(infile,domain) for infile in files]
+    for i,outfiles in enumerate(pool.imap_unordered(process_file_star,tasks)):
+        print 'done with outfiles', outfiles, '(',i+1,'of',len(files),')'
+    pool.close()
+    pool.join()
 
-        
-        print 'done with outfile', outfile2, '(',i,'of',len(files),')'
+
+def process_file_star(args):
+    return process_file(*args)
+
+
+def process_file(infile,domain):
+    """
+    Fix the coordinates of infile and remap its forcing variables to the
+    domain grid with each method.  The input is read once, timechunk steps of
+    one variable at a time, and each output is written once (to a temporary
+    name that is renamed when complete) as a compressed NETCDF4 file.
+    """
+    lat, lon = fixed_coords(infile)
+    shape = domain['lat'].shape
+    f = Dataset(infile,'r')
+    ntime = f.variables[forcing_vars[0][0]].shape[0]
+
+    outputs = []
+    for method, suffix in methods:
+        weights = get_weights(method,lat,lon,domain,cache_dir=weightpath)
+        outfile = outpath+infile[:-3]+suffix
+        tmpfile = '{0}.{1}.tmp'.format(outfile,os.getpid())
+        rootgrp = create_output(tmpfile,domain,ntime,f.variables['time'],method)
+        outputs.append((weights,rootgrp,tmpfile,outfile))
+
+    for invar, var in forcing_vars:
+        ncvar = f.variables[invar]
+        attrs = dict((k,v) for k,v in ncvar.__dict__.iteritems() if k in ('units','long_name'))
+        if dtype is None:
+            # the remapped values are packed like the source when written
+            outtype = ncvar.dtype
+            attrs.update((k,v) for k,v in ncvar.__dict__.iteritems() if k in packing_attrs)
+        else:
+            outtype = np.dtype(dtype)
+        fill_value = getattr(ncvar,'_FillValue',None)
+        if fill_value is None or outtype != ncvar.dtype:
+            fill_value = default_fillvals[outtype.str[1:]]
+        outvars = []
+        for weights, rootgrp, tmpfile, outfile in outputs:
+            outvar = rootgrp.createVariable(var,outtype,('time','nj','ni',),fill_value=fill_value,
+                                            zlib=True,complevel=complevel,shuffle=True,
+                                            chunksizes=(min(timechunk,ntime),)+shape)
+            outvar.setncatts(attrs)
+            outvars.append(outvar)
+        for t0 in xrange(0,ntime,timechunk):
+            data = ncvar[t0:t0+timechunk]
+            for (weights, rootgrp, tmpfile, outfile), outvar in zip(outputs,outvars):
+                outvar[t0:t0+timechunk,:,:] = remap(weights,data,shape)
+    f.close()
+
+    for weights, rootgrp, tmpfile, outfile in outputs:
+        rootgrp.close()
+        os.rename(tmpfile,outfile)
+    return [outfile for weights, rootgrp, tmpfile, outfile in outputs]
+
+
+def fixed_coords(infile):
+    """
+    Return the regular 1d lats and lons (res degrees, from the minimum
+    nav_lat/nav_lon) of the rows and columns of infile
+    """
+    data, attrs = read_netcdf(infile,vars=('nav_lat','nav_lon'))
+    ny, nx = data['nav_lat'].shape[-2:]
+    lat = data['nav_lat'].min()+np.arange(ny)*res
+    lon = data['nav_lon'].min()+np.arange(nx)*res
+    return lat, lon
+
+
+def create_output(outfile,domain,ntime,intime,method):
+    """
+    Create an output file on the domain grid, with the time of the input
+    (days from the start, in the input units) and the xc/yc coordinates.
+    """
+    shape = domain['lat'].shape
+    rootgrp = Dataset(outfile,'w', format='NETCDF4')
+    rootgrp.createDimension('time',ntime)
+    rootgrp.createDimension('nj',shape[0])
+    rootgrp.createDimension('ni',shape[1])
+
+    times = rootgrp.createVariable('time','f8',('time',))
+    times[:] = np.arange(ntime)*86400
+    times.units = intime.units
+    times.long_name = intime.long_name
+
+    yc = rootgrp.createVariable('yc','f8',('nj','ni',))
+    yc[:,:] = domain['lat']
+    yc.units = 'degrees_north'
+    yc.long_name = 'latitude of grid cell center'
+
+    xc = rootgrp.createVariable('xc','f8',('nj','ni',))
+    xc[:,:] = domain['lon']
+    xc.units = 'degrees_east'
+    xc.long_name = 'longitude of grid cell center'
+
+    rootgrp.history = 'Created: {}\n'.format(tm.ctime(tm.time()))
+    rootgrp.source = sys.argv[0] # prints the name of script used
+    rootgrp.remap_method = method
+    return rootgrp
 
 
 ##################################################################################
@@ -66,55 +180,63 @@ def read_netcdf(ncFile,vars = [],coords = False, verbose = False):
     f.close()
     return d,a
 
-def fix_netcdf(infile,outfile):
+def fix_netcdf(infile,outfile,dtype=None,chunk=None,complevel=4):
     """
-    Write a new netcdf but this time do the coordinate vars correctly
+    Write a new netcdf but this time do the coordinate vars correctly.
+    Variables are copied chunk (time steps) at a time and keep the dtype (and
+    packing) of the source unless dtype is given.  The output is a compressed
+    NETCDF4 file.
     """
-    rootgrp = Dataset(outfile,'w', format='NETCDF3_64BIT')
+    if chunk is None:
+        chunk = timechunk
+    rootgrp = Dataset(outfile,'w', format='NETCDF4')
 
-    data, targetAttrs = read_netcdf(infile,vars=('Prec','Wind','Tmax','Tmin','time','nav_lat','nav_lon'))
-    res = 0.5
+    lats, lons = fixed_coords(infile)
+    f = Dataset(infile,'r')
+    ntime = f.variables[forcing_vars[0][0]].shape[0]
     # set dimensions
-    lon = rootgrp.createDimension('lon',data['Prec'].shape[2])
-    lat = rootgrp.createDimension('lat',data['Prec'].shape[1])
-    time = rootgrp.createDimension('time',data['Prec'].shape[0])
+    rootgrp.createDimension('lon',len(lons))
+    rootgrp.createDimension('lat',len(lats))
+    rootgrp.createDimension('time',ntime)
 
     # do vars
     
     times = rootgrp.createVariable('time','f8',('time',))
-    times[:] = np.arange(data['Prec'].shape[0])*86400
-    times.units = targetAttrs['time']['units']
-    times.long_name = targetAttrs['time']['long_name']
+    times[:] = np.arange(ntime)*86400
+    times.units = f.variables['time'].units
+    times.long_name = f.variables['time'].long_name
     
     lat = rootgrp.createVariable('lat','f8',('lat',))
-    lat[:] = np.arange(data['nav_lat'].min(),data['nav_lat'].max()+res,res)
+    lat[:] = lats
     lat.units = 'degrees_north'
     lat.long_name = 'Latitude'
     
     lon = rootgrp.createVariable('lon','f8',('lon',))
-    lon[:] = np.arange(data['nav_lon'].min(),data['nav_lon'].max()+res,res)
+    lon[:] = lons
     lon.units = 'degrees_east'
     lon.long_name = 'Longitude'
-    
-    Precip = rootgrp.createVariable('Precip','f8',('time','lat','lon',),fill_value=data['Prec'].fill_value)
-    Precip[:,:,:] = data['Prec']
-    Precip.units = targetAttrs['Prec']['units']
-    Precip.long_name = targetAttrs['Prec']['long_name']
-    
-    Tmax = rootgrp.createVariable('Tmax','f8',('time','lat','lon',),fill_value=data['Tmax'].fill_value)
-    Tmax[:,:,:] = data['Tmax']
-    Tmax.units = targetAttrs['Tmax']['units']
-    Tmax.long_name = targetAttrs['Tmax']['long_name']
-
-    Tmin = rootgrp.createVariable('Tmin','f8',('time','lat','lon',),fill_value=data['Tmin'].fill_value)
-    Tmin[:,:,:] = data['Tmin']
-    Tmin.units = targetAttrs['Tmin']['units']
-    Tmin.long_name = targetAttrs['Tmin']['long_name']    
-
-    Wind = rootgrp.createVariable('Wind','f8',('time','lat','lon',),fill_value=data['Wind'].fill_value)
-    Wind[:,:,:] = data['Wind']
-    Wind.units = targetAttrs['Wind']['units']
-    Wind.long_name = targetAttrs['Wind']['long_name']
+
+    for invar, var in forcing_vars:
+        ncvar = f.variables[invar]
+        fill_value = getattr(ncvar,'_FillValue',None)
+        attrs = dict((k,v) for k,v in ncvar.__dict__.iteritems() if k in ('units','long_name'))
+        if dtype is None:
+            # copy the stored (packed) values as they are
+            outtype = ncvar.dtype
+            ncvar.set_auto_maskandscale(False)
+            attrs.update((k,v) for k,v in ncvar.__dict__.iteritems() if k in packing_attrs)
+        else:
+            outtype = np.dtype(dtype)
+            if fill_value is not None or outtype.kind == 'f':
+                fill_value = default_fillvals[outtype.str[1:]]
+        outvar = rootgrp.createVariable(var,outtype,('time','lat','lon',),fill_value=fill_value,
+                                        zlib=True,complevel=complevel)
+        outvar.setncatts(attrs)
+        if dtype is None:
+            outvar.set_auto_maskandscale(False)
+        for t0 in xrange(0,ntime,chunk):
+            outvar[t0:t0+chunk,:,:] = ncvar[t0:t0+chunk]
+    f.close()
     
     rootgrp.description = 'Global 1/2 Degree Gridded Meteorological VIC Forcing Data Set '
     rootgrp.history = 'Created: {}\n'.format(tm.ctime(tm.time()))
@@ -2,68 +2,719 @@
 
 from __future__ import print_function
 import numpy as np
+import re
 import struct
-from netCDF4 import Dataset
+import sys
+import threading
+import Queue
+from netCDF4 import Dataset, date2num, num2date, default_fillvals
 import os
 import argparse
+import datetime
 import ConfigParser
+import multiprocessing
+from collections import OrderedDict
+
+# the netCDF/HDF5 library is not thread safe, calls that may run while the
+# prefetch thread is reading hold this lock
+NC_LOCK = threading.RLock()
 
 
 ###############################################################################
 def main():
     (files, coord_keys, var_keys, output, binary_mult, binary_type, paths,
-     out_prefix, verbose) = process_command_line()
+     out_prefix, verbose, options) = process_command_line()
 
     mask = read_netcdf(paths['mask_path'], nc_vars=['mask'])['mask']
     yi, xi = np.nonzero(mask)
     print('found {0} points in mask file.'.format(len(yi)))
 
-    xlist = []
-    ylist = []
-    pointlist = []
-    append = False
+    time_slices = [slice(None)] * len(files)
+    if options['time_window']:
+        time_slices = select_times(files, paths['in_path'],
+                                   options['time_key'],
+                                   options['time_window'])
+        files = [fname for fname, t in zip(files, time_slices) if t]
+        time_slices = [t for t in time_slices if t]
+        print('{0} input files overlap the time window'.format(len(files)))
+        if not files:
+            return
 
-    for i, fname in enumerate(files):
-        d = read_netcdf(os.path.join(paths['in_path'], fname),
-                        verbose=verbose)
+    first_file = os.path.join(paths['in_path'], files[0])
+    key = cell_cache_key(paths['mask_path'], first_file, var_keys,
+                         subset=(options['bbox'], time_slices[0]))
+    cells = None
+    if paths['cell_cache']:
+        cells = read_cell_cache(paths['cell_cache'], key)
+    if cells is None:
+        cells = find_active_cells(first_file, mask, var_keys,
+                                  options['memory_budget'],
+                                  bbox=options['bbox'],
+                                  time_slice=time_slices[0], verbose=verbose)
+        if paths['cell_cache']:
+            write_cell_cache(paths['cell_cache'], key, *cells)
+    else:
+        print('read active cells from cache: {0}'.format(paths['cell_cache']))
+    ylist, xlist, pointlist = cells
 
-        if i == 0:
+    workers = min(options['workers'], len(ylist))
+    if output['NetCDF'] and workers > 1:
+        print('NetCDF output is written by one process, ignoring --workers')
+        workers = 1
+    if workers > 1:
+        # cells are in row major order so each group is a band of rows, the
+        # memory budgets are shared between the workers
+        worker_options = dict(options)
+        worker_options['memory_budget'] /= workers
+        worker_options['output_buffer'] /= workers
+        jobs = []
+        for cells in np.array_split(np.arange(len(ylist)), workers):
+            jobs.append((files, time_slices, ylist[cells], xlist[cells],
+                         [pointlist[c] for c in cells], var_keys, output,
+                         binary_mult, binary_type, paths, out_prefix,
+                         worker_options, verbose))
+        print('writing {0} cells with {1} workers'.format(len(ylist),
+                                                          workers))
+        pool = multiprocessing.Pool(processes=workers)
+        pool.map(write_cells_star, jobs)
+        pool.close()
+        pool.join()
+    else:
+        write_cells(files, time_slices, ylist, xlist, pointlist, var_keys,
+                    output, binary_mult, binary_type, paths, out_prefix,
+                    options, verbose)
 
-            # find point locations
-            xs = d['xc']
-            ys = d['yc']
-            posinds = np.nonzero(xs > 180)
-            xs[posinds] -= 360
-            print('adjusted xs lon minimum')
 
-            for y, x in zip(yi, xi):
-                active_flag = False
-                for key in var_keys:
-                    if (d[key][:, y, x].all() is np.ma.masked) \
-                            or (mask[y, x] == 0):
-                        active_flag = True
-                if not active_flag:
-                    point = (ys[y, x], xs[y, x])
-                    xlist.append(x)
-                    ylist.append(y)
-                    pointlist.append(point)
+###############################################################################
+def write_cells(files, time_slices, ylist, xlist, pointlist, var_keys, output,
+                binary_mult, binary_type, paths, out_prefix, options,
+                verbose=False):
+    """
+    Read the cells (ylist, xlist) from the input files (the steps in
+    time_slices) as one MultiFileDataset and write the VIC forcing file of
+    each cell.
+    """
+    out = OutputManager(options['output_buffer'], options['max_open_files'])
+    data = MultiFileDataset([os.path.join(paths['in_path'], fname)
+                             for fname in files], time_slices=time_slices,
+                            max_open=options['max_open_inputs'])
+    if output['NetCDF']:
+        image = ImageWriter(data, var_keys, ylist, xlist,
+                            paths['NetCDFoutPath'], out_prefix,
+                            options['time_key'], chunks=options['nc_chunks'],
+                            verbose=verbose)
+    if verbose:
+        print('Reading input data nc_vars: '
+              '{0} from {1} files'.format(var_keys, len(files)))
+
+    # blocks hold the steps of one input file, the output buffers join the
+    # steps of each cell across the files
+    align = (1, 1)
+    if output['NetCDF']:
+        # write whole (y, x) chunks of the image files
+        align = image.chunks[1:]
+    # with prefetching the queue holds prefetch blocks, the reading thread
+    # one more waiting to be queued and the writer the one being written
+    nblocks = 1
+    if options['prefetch'] > 0:
+        nblocks = options['prefetch'] + 2
+    blocks = read_blocks(data, var_keys, ylist, xlist,
+                         options['memory_budget'] / nblocks, align=align)
+    for tile, steps, block in prefetch(blocks, options['prefetch']):
+        if output['NetCDF']:
+            image.write_block(tile, steps, block)
+        append = steps.start > 0
+        y0, x0 = tile[0].start, tile[1].start
+        for c in cells_in_tile(ylist, xlist, tile):
+            cell = block[ylist[c]-y0, xlist[c]-x0]
+
+            if output['Binary']:
+                write_binary(cell*binary_mult, pointlist[c], binary_type,
+                             out_prefix, paths['BinaryoutPath'], append,
+                             out=out)
+            if output['ASCII']:
+                write_ASCII(cell, pointlist[c], out_prefix,
+                            paths['ASCIIoutPath'], append, out=out)
+    out.close()
+    if output['NetCDF']:
+        image.close()
+    with NC_LOCK:
+        data.close()
+
+
+###############################################################################
+def write_cells_star(args):
+    """Unpack the arguments of write_cells (for multiprocessing.Pool.map)"""
+    return write_cells(*args)
+
+
+###############################################################################
+def prefetch(iterable, depth):
+    """
+    Iterate over iterable in a background thread, keeping up to depth items
+    ready ahead of the caller.  Up to depth + 2 items are alive at once: the
+    queued ones, the one being produced and the caller's.  Exceptions are
+    raised in the caller.  With a depth of 0 the items are produced in the
+    calling thread.
+    """
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
 
+    queue = Queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except Exception:
+            queue.put((None, sys.exc_info()))
         else:
-            append = True
+            queue.put((done, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item, error = queue.get()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if item is done:
+            break
+        yield item
+    thread.join()
+
+
+###############################################################################
+class MultiFileDataset(object):
+    """
+    Present an ordered list of netCDF files as one dataset.  Each variable
+    is concatenated along its first (time) dimension, optionally using only
+    the steps in time_slices of each file, and read lazily.  At most max_open
+    files are kept open, the least recently used is closed first.
+    """
+    def __init__(self, paths, time_slices=None, max_open=64):
+        self.paths = list(paths)
+        if time_slices is None:
+            time_slices = [slice(None)] * len(self.paths)
+        self.time_slices = time_slices
+        self.max_open = max(int(max_open), 1)
+        self.handles = OrderedDict()
+        self.variables = MultiFileVariables(self)
+        self._lengths = {}
+
+    def dataset(self, i):
+        """Return the open Dataset of file i"""
+        f = self.handles.pop(i, None)
+        if f is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            f = Dataset(self.paths[i], 'r')
+        self.handles[i] = f
+        return f
+
+    def lengths(self, dim):
+        """
+        Return the length of dimension dim in each file, and the number of
+        steps used (in time_slices).
+        """
+        if dim not in self._lengths:
+            full = np.array([len(self.dataset(i).dimensions[dim])
+                             for i in xrange(len(self.paths))], dtype=int)
+            used = np.array([len(xrange(*t.indices(n))) for t, n in
+                             zip(self.time_slices, full)], dtype=int)
+            self._lengths[dim] = (full, used)
+        return self._lengths[dim]
+
+    def dates(self, time_key='time'):
+        """Return the dates of all steps, using each file's units/calendar"""
+        dates = []
+        for i in xrange(len(self.paths)):
+            time = self.dataset(i).variables[time_key]
+            dates.extend(np.atleast_1d(num2date(
+                time[self.time_slices[i]], time.units,
+                getattr(time, 'calendar', 'standard'))))
+        return np.array(dates)
+
+    def close(self):
+        """Close all open files"""
+        for f in self.handles.itervalues():
+            f.close()
+        self.handles.clear()
+
+
+class MultiFileVariables(dict):
+    """Variables of a MultiFileDataset, created when first used"""
+    def __init__(self, dataset):
+        dict.__init__(self)
+        self.dataset = dataset
+
+    def __missing__(self, name):
+        self[name] = MultiFileVariable(self.dataset, name)
+        return self[name]
+
+
+class MultiFileVariable(object):
+    """
+    A variable of a MultiFileDataset.  The first index may be an integer or a
+    slice, the other indexes are passed to each file.
+    """
+    def __init__(self, dataset, name):
+        self.dataset = dataset
+        self.name = name
+        var = dataset.dataset(0).variables[name]
+        self.dimensions = var.dimensions
+        self.dtype = var.dtype
+        self.full, used = dataset.lengths(var.dimensions[0])
+        self.offsets = np.concatenate(([0], np.cumsum(used)))
+        self.shape = (int(self.offsets[-1]), ) + var.shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        index, rest = key[0], key[1:]
+        if isinstance(index, (int, long, np.integer)):
+            if index < 0:
+                index += self.shape[0]
+            if not 0 <= index < self.shape[0]:
+                raise IndexError('index {0} is out of bounds for {1} with '
+                                 'size {2}'.format(key[0], self.name,
+                                                   self.shape[0]))
+            return np.squeeze(self[(slice(index, index+1), ) + rest], axis=0)
+        if not isinstance(index, slice):
+            raise IndexError('only integers and slices are supported for the '
+                             'first index of {0}'.format(self.name))
+
+        start, stop, step = index.indices(self.shape[0])
+        if step != 1:
+            return self[(slice(start, max(stop, start)), ) + rest][::step]
+        parts = []
+        for i in xrange(len(self.full)):
+            lo = max(start, self.offsets[i]) - self.offsets[i]
+            hi = min(stop, self.offsets[i+1]) - self.offsets[i]
+            if hi <= lo and parts:
+                break
+            if hi <= lo:
+                continue
+            t0, t1, tstep = self.dataset.time_slices[i].indices(self.full[i])
+            steps = slice(t0 + lo*tstep, t0 + hi*tstep, tstep)
+            var = self.dataset.dataset(i).variables[self.name]
+            parts.append(var[(steps, ) + rest])
+        if not parts:
+            var = self.dataset.dataset(0).variables[self.name]
+            return var[(slice(0, 0), ) + rest]
+        if len(parts) == 1:
+            return parts[0]
+        return np.ma.concatenate(parts, axis=0)
 
-        for y, x, point in zip(ylist, xlist, pointlist):
 
-            data = np.empty((d[var_keys[0]].shape[0], len(var_keys)))
+###############################################################################
+class ImageWriter(object):
+    """
+    Write the forcings as VIC 5 image driver netCDF files, one file per year
+    ({out_prefix}{year}.nc) with (time, lat, lon) variables.  Cells that are
+    not active are left as fill values.  Variables are compressed and chunked
+    as (a year of steps, 1 row, a part of the row), by default about 1 MB,
+    with a chunk cache that holds one row of chunks.
+    """
+    def __init__(self, data, var_keys, ylist, xlist, out_path, out_prefix,
+                 time_key='time', chunks=None, verbose=False):
+        self.var_keys = var_keys
+
+        d = read_netcdf(data.paths[0], nc_vars=['xc', 'yc'])
+        xs, ys = d['xc'], d['yc']
+        xs[xs > 180] -= 360
+        if not (np.allclose(ys, ys[:, :1]) and np.allclose(xs, xs[:1, :])):
+            raise ValueError('NetCDF output requires a regular lat/lon grid '
+                             'in {0}'.format(data.paths[0]))
+        lats = np.asarray(ys[:, 0], dtype=np.float64)
+        lons = np.asarray(xs[0, :], dtype=np.float64)
+
+        self.active = np.zeros(ys.shape, dtype=bool)
+        self.active[ylist, xlist] = True
+
+        with NC_LOCK:
+            f = data.dataset(0)
+            time = f.variables[time_key]
+            units = time.units
+            calendar = getattr(time, 'calendar', 'standard')
+            var_attrs = {}
+            for key in var_keys:
+                var = f.variables[key]
+                var_attrs[key] = dict((attr, var.getncattr(attr))
+                                      for attr in ['units', 'long_name']
+                                      if attr in var.ncattrs())
+            dates = data.dates(time_key)
+        if chunks is None:
+            # a year of steps (from the first time step) and ~1 MB chunks
+            dt = 1.
+            if len(dates) > 1:
+                dt = np.diff(date2num(list(dates[:2]),
+                                      'days since 2000-01-01', calendar))[0]
+            tchunk = int(np.ceil(366 / dt))
+            chunks = (tchunk, 1, max(min(len(lons), 2 ** 18 // tchunk), 1))
+        self.chunks = chunks
+        # tiles with fewer rows than a chunk write the same row of chunks
+        # again, keep one row of chunks in the cache
+        cache_size = (4 * chunks[0] * chunks[1] * chunks[2] *
+                      int(np.ceil(len(lons) / float(chunks[2]))))
+
+        # one file per year, with the (year, steps of the series) groups
+        years = np.array([date.year for date in dates])
+        bounds = np.concatenate(([0], np.nonzero(np.diff(years))[0] + 1,
+                                 [len(years)]))
+        self.groups = []
+        self.open_files = OrderedDict()
+        with NC_LOCK:
+            for t0, t1 in zip(bounds[:-1], bounds[1:]):
+                year = years[t0]
+                if year in self.open_files:
+                    raise ValueError('The input times are not in order, '
+                                     'found {0} twice'.format(year))
+                out_file = os.path.join(out_path, '{0}{1}.nc'.format(
+                    out_prefix, year))
+                if verbose:
+                    print('Creating NetCDF forcing file '
+                          '{0}'.format(out_file))
+                f = Dataset(out_file, 'w', format='NETCDF4')
+                f.createDimension('time', None)
+                f.createDimension('lat', len(lats))
+                f.createDimension('lon', len(lons))
+                time = f.createVariable('time', 'f8', ('time', ))
+                time.units = units
+                time.calendar = calendar
+                time[:] = date2num(list(dates[t0:t1]), units, calendar)
+                lat = f.createVariable('lat', 'f8', ('lat', ))
+                lat.units = 'degrees_north'
+                lat[:] = lats
+                lon = f.createVariable('lon', 'f8', ('lon', ))
+                lon.units = 'degrees_east'
+                lon[:] = lons
+                for key in var_keys:
+                    var = f.createVariable(key, 'f4', ('time', 'lat', 'lon'),
+                                           zlib=True, chunksizes=chunks,
+                                           fill_value=default_fillvals['f4'])
+                    var.setncatts(var_attrs[key])
+                    var.set_var_chunk_cache(size=cache_size)
+                f.source = 'netcdf2vic.py'
+                self.open_files[year] = f
+                self.groups.append((year, slice(t0, t1)))
+
+    def write_block(self, tile, steps, block):
+        """
+        Write the (y, x, time, nvars) block of tile, holding the steps
+        (a slice) of the time series
+        """
+        inactive = ~self.active[tile]
+        for year, group in self.groups:
+            t0 = max(group.start, steps.start)
+            t1 = min(group.stop, steps.stop)
+            if t1 <= t0:
+                continue
+            var_slice = (slice(t0 - group.start, t1 - group.start), ) + tile
+            for j, key in enumerate(self.var_keys):
+                data = np.rollaxis(
+                    block[:, :, t0 - steps.start:t1 - steps.start, j], 2)
+                data = np.ma.masked_array(
+                    data, mask=np.broadcast_to(inactive, data.shape))
+                with NC_LOCK:
+                    self.open_files[year].variables[key][var_slice] = data
+
+    def close(self):
+        """Close the output files"""
+        with NC_LOCK:
+            for f in self.open_files.itervalues():
+                f.close()
+        self.open_files.clear()
+
+
+###############################################################################
+class OutputManager(object):
+    """
+    Buffer the data written to each output file in memory (across input
+    files) and flush it with one write per file once the buffered data
+    exceeds buffer_size (bytes).  At most max_open files are kept open, the
+    least recently used handle is closed first.
+    """
+    def __init__(self, buffer_size, max_open=256):
+        self.buffer_size = buffer_size
+        self.max_open = max(int(max_open), 1)
+        self.buffers = OrderedDict()
+        self.buffered = 0
+        self.handles = OrderedDict()
+        # files that have been created (truncated) in this run
+        self.created = set()
+
+    def write(self, out_file, data, append=True):
+        """Add data (a string) to the buffer of out_file"""
+        if not append:
+            # start the file over, drop anything buffered from before
+            self.buffered -= sum(len(b) for b in
+                                 self.buffers.pop(out_file, []))
+            self.close_handle(out_file)
+            self.created.discard(out_file)
+        self.buffers.setdefault(out_file, []).append(data)
+        self.buffered += len(data)
+        if self.buffered > self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered data, one write per file"""
+        for out_file, chunks in self.buffers.iteritems():
+            self.get_handle(out_file).write(b''.join(chunks))
+        self.buffers.clear()
+        self.buffered = 0
+
+    def get_handle(self, out_file):
+        """Return an open handle for out_file, from the LRU set if possible"""
+        f = self.handles.pop(out_file, None)
+        if f is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            if out_file in self.created:
+                f = open(out_file, 'ab')
+            else:
+                f = open(out_file, 'wb')
+                self.created.add(out_file)
+        self.handles[out_file] = f
+        return f
+
+    def close_handle(self, out_file):
+        """Close the handle of out_file if it is open"""
+        f = self.handles.pop(out_file, None)
+        if f is not None:
+            f.close()
+
+    def close(self):
+        """Flush the buffers and close all open files"""
+        self.flush()
+        for f in self.handles.itervalues():
+            f.close()
+        self.handles.clear()
+
 
+###############################################################################
+def find_active_cells(nc_file, mask, var_keys, memory_budget, bbox=None,
+                      time_slice=slice(None), verbose=False):
+    """
+    Find the mask cells (inside bbox, (min_lat, max_lat, min_lon, max_lon))
+    that have data in time_slice for every variable in var_keys.
+    Returns arrays of the y and x indexes and a list of (lat, lon) points.
+    """
+    if verbose:
+        print('Finding active cells in file: {0}'.format(nc_file))
+    d = read_netcdf(nc_file, nc_vars=['xc', 'yc'])
+
+    # find point locations
+    xs = d['xc']
+    ys = d['yc']
+    posinds = np.nonzero(xs > 180)
+    xs[posinds] -= 360
+    print('adjusted xs lon minimum')
+
+    if bbox:
+        inside = ((ys >= bbox[0]) & (ys <= bbox[1]) &
+                  (xs >= bbox[2]) & (xs <= bbox[3]))
+        mask = np.where(np.ma.filled(inside, False), mask, 0)
+    yi, xi = np.nonzero(mask)
+    f = Dataset(nc_file, 'r')
+
+    # a cell is active if it is in the mask and no variable is masked for
+    # the whole time series
+    active = np.ma.filled(mask, 0) != 0
+    for tile in get_tiles(f, var_keys, yi, xi, memory_budget, time_slice):
+        for key in var_keys:
+            missing = np.ma.getmaskarray(
+                f.variables[key][(time_slice, ) + tile]).all(axis=0)
+            active[tile] &= ~missing
+    f.close()
+
+    ylist, xlist = np.nonzero(active)
+    pointlist = zip(ys[ylist, xlist], xs[ylist, xlist])
+    print('found {0} active points.'.format(len(ylist)))
+
+    return ylist, xlist, pointlist
+
+
+###############################################################################
+def cell_cache_key(mask_file, nc_file, var_keys, subset=None):
+    """
+    Return a string identifying the inputs of find_active_cells, from the
+    names, sizes and modification times of the files, the variables and the
+    subset (bbox and time slice).
+    """
+    key = []
+    for path in [mask_file, nc_file]:
+        stat = os.stat(path)
+        key.append('{0}:{1}:{2}'.format(os.path.abspath(path), stat.st_size,
+                                        stat.st_mtime))
+    key.append(','.join(var_keys))
+    if subset is not None:
+        key.append(repr(subset))
+    return '|'.join(key)
+
+
+###############################################################################
+def read_cell_cache(cache_file, key):
+    """
+    Read the active cells from cache_file (.npz), returns None if the file
+    does not exist or was made from different inputs.
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    cache = dict(np.load(cache_file))
+    if str(cache['key']) != key:
+        print('cell cache {0} does not match the inputs, '
+              'ignoring it'.format(cache_file))
+        return None
+    pointlist = zip(cache['lats'], cache['lons'])
+    return cache['ylist'], cache['xlist'], pointlist
+
+
+###############################################################################
+def write_cell_cache(cache_file, key, ylist, xlist, pointlist):
+    """
+    Write the active cells and their (lat, lon) points to cache_file (.npz)
+    """
+    points = np.array(pointlist, dtype=np.float64).reshape(-1, 2)
+    with open(cache_file, 'wb') as f:
+        np.savez(f, key=key, ylist=ylist, xlist=xlist, lats=points[:, 0],
+                 lons=points[:, 1])
+
+
+###############################################################################
+def get_tiles(f, var_keys, ylist, xlist, memory_budget,
+              time_slice=slice(None), align=(1, 1)):
+    """
+    Split the bounding box of the cells (ylist, xlist) into tiles of whole
+    rows (or parts of a row) whose (time, nvars) blocks fit in memory_budget
+    (bytes).  Tile bounds are multiples of align (y, x) where possible, so
+    tiles cover whole chunks of an output with those chunk sizes.  Tiles are
+    returned as (y, x) slices in row major order.
+    """
+    if not len(ylist):
+        return []
+
+    ntime = len(xrange(*time_slice.indices(f.variables[var_keys[0]].shape[0])))
+    # block (float64) and the masked arrays read from the file
+    cell_bytes = ntime * len(var_keys) * (8 + 8 + 1)
+
+    ny, nx = f.variables[var_keys[0]].shape[-2:]
+    ay, ax = align
+    y0 = ylist.min() // ay * ay
+    y1 = min(-(-(ylist.max() + 1) // ay) * ay, ny)
+    x0 = xlist.min() // ax * ax
+    x1 = min(-(-(xlist.max() + 1) // ax) * ax, nx)
+
+    tiles = []
+    rows = int(memory_budget // (cell_bytes * (x1 - x0)))
+    if rows >= ay:
+        rows -= rows % ay
+        for y in xrange(y0, y1, rows):
+            tiles.append((slice(y, min(y+rows, y1)), slice(x0, x1)))
+    else:
+        cols = max(int(memory_budget // cell_bytes), 1)
+        if cols >= ax:
+            cols -= cols % ax
+        for y in xrange(y0, y1):
+            for x in xrange(x0, x1, cols):
+                tiles.append((slice(y, y+1), slice(x, min(x+cols, x1))))
+    return tiles
+
+
+###############################################################################
+def cells_in_tile(ylist, xlist, tile):
+    """
+    Return the indexes of the cells (ylist, xlist) that fall in tile
+    """
+    return np.nonzero((ylist >= tile[0].start) & (ylist < tile[0].stop) &
+                      (xlist >= tile[1].start) & (xlist < tile[1].stop))[0]
+
+
+###############################################################################
+def read_blocks(f, var_keys, ylist, xlist, memory_budget,
+                time_slice=slice(None), align=(1, 1)):
+    """
+    Read the variables in var_keys from f (an open Dataset or a
+    MultiFileDataset), one tile at a time, and yield the tile, the steps
+    (a slice of the steps in time_slice) and a (y, x, steps, nvars) block so
+    that each cell's (steps, nvars) data is contiguous.  A MultiFileDataset
+    is read one file at a time, with tiles sized to the steps of that file.
+    Tiles are aligned to align (y, x), see get_tiles.
+    """
+    with NC_LOCK:
+        var = f.variables[var_keys[0]]
+        start, stop, step = time_slice.indices(var.shape[0])
+        ntime = len(xrange(start, stop, step))
+        # (steps of the output, steps of the input) read at a time
+        spans = [(slice(0, ntime), time_slice)]
+        if isinstance(var, MultiFileVariable) and step == 1:
+            bounds = np.unique(np.concatenate((
+                [0], np.clip(var.offsets[1:-1] - start, 0, ntime), [ntime])))
+            spans = [(slice(t0, t1), slice(start + t0, start + t1))
+                     for t0, t1 in zip(bounds[:-1], bounds[1:])]
+    for steps, span in spans:
+        with NC_LOCK:
+            tiles = get_tiles(f, var_keys, ylist, xlist, memory_budget, span,
+                              align)
+        for tile in tiles:
+            if not len(cells_in_tile(ylist, xlist, tile)):
+                continue
+            ny = tile[0].stop - tile[0].start
+            nx = tile[1].stop - tile[1].start
+            block = np.empty((ny, nx, steps.stop - steps.start,
+                              len(var_keys)))
             for j, key in enumerate(var_keys):
-                data[:, j] = d[key][:, y, x]
+                with NC_LOCK:
+                    data = f.variables[key][(span, ) + tile]
+                block[:, :, :, j] = np.rollaxis(data, 0, 3)
+            yield tile, steps, block
 
-            if output['Binary']:
-                write_binary(data*binary_mult, point, binary_type,
-                             out_prefix, paths['BinaryoutPath'], append)
-            if output['ASCII']:
-                write_ASCII(data, point, out_prefix, paths['ASCIIoutPath'],
-                            append)
+
+###############################################################################
+def select_times(files, in_path, time_key, time_window):
+    """
+    Return the slice of the time steps of each file that fall in time_window,
+    (start, end) datetimes, both included.  The slice is None for files with
+    no steps in the window.
+    """
+    time_slices = []
+    for fname in files:
+        f = Dataset(os.path.join(in_path, fname), 'r')
+        time = f.variables[time_key]
+        calendar = getattr(time, 'calendar', 'standard')
+        bounds = date2num(list(time_window), time.units, calendar=calendar)
+        t0 = np.searchsorted(time[:], bounds[0], side='left')
+        t1 = np.searchsorted(time[:], bounds[1], side='right')
+        f.close()
+        if t1 > t0:
+            time_slices.append(slice(t0, t1))
+        else:
+            time_slices.append(None)
+    return time_slices
+
+
+###############################################################################
+def parse_date(date, end=False):
+    """
+    Parse a date string (YYYY-MM-DD[ HH[:MM[:SS]]]).  For end dates given as
+    a day the whole day is included, so the last second of it is returned.
+    """
+    date = date.strip()
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H']:
+        try:
+            return datetime.datetime.strptime(date, fmt)
+        except ValueError:
+            pass
+    day = datetime.datetime.strptime(date, '%Y-%m-%d')
+    if end:
+        day += datetime.timedelta(days=1, seconds=-1)
+    return day
 
 
 ###############################################################################
@@ -75,13 +726,17 @@ def process_command_line():
     # Parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("config", type=str, help="Input Configuration File")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes, each writes a disjoint "
+                             "group of cells")
     args = parser.parse_args()
 
     (files, coord_keys, var_keys, output, binary_mult, binary_type, paths,
-        out_prefix, verbose) = process_config(args.config)
+        out_prefix, verbose, options) = process_config(args.config)
+    options['workers'] = max(args.workers, 1)
 
     return (files, coord_keys, var_keys, output, binary_mult, binary_type,
-            paths, out_prefix, verbose)
+            paths, out_prefix, verbose, options)
 
 
 ###############################################################################
@@ -101,14 +756,23 @@ def process_config(config_file):
     WC_Start = config.getint('Basics', 'WC_Start')
     WC_End = config.getint('Basics', 'WC_End')
     output = {'Binary': config.getboolean('Basics', 'Binary'),
-              'ASCII': config.getboolean('Basics', 'ASCII')}
+              'ASCII': config.getboolean('Basics', 'ASCII'),
+              'NetCDF': False}
+    if config.has_option('Basics', 'NetCDF'):
+        output['NetCDF'] = config.getboolean('Basics', 'NetCDF')
     paths = {'in_path': config.get('Paths', 'in_path'),
-             'mask_path': config.get('Paths', 'mask')}
+             'mask_path': config.get('Paths', 'mask'),
+             'cell_cache': None}
+    if config.has_option('Paths', 'cell_cache'):
+        paths['cell_cache'] = config.get('Paths', 'cell_cache')
     File_str = config.get('Basics', 'File')
 
     if output['ASCII']:
         paths['ASCIIoutPath'] = config.get('Paths', 'ASCIIoutPath')
 
+    if output['NetCDF']:
+        paths['NetCDFoutPath'] = config.get('Paths', 'NetCDFoutPath')
+
     if output['Binary']:
         binary_mult = map(int, config.get('Basics', 'Mult').split(','))
         binary_type = config.get('Basics', 'Type')
@@ -118,6 +782,44 @@ def process_config(config_file):
         binary_type = ""
 
     out_prefix = config.get('Basics', 'out_prefix')
+
+    # Optional settings
+    options = {'memory_budget': 1024, 'output_buffer': 256,
+               'max_open_files': 256, 'workers': 1, 'time_key': 'time',
+               'time_window': None, 'bbox': None, 'prefetch': 2,
+               'nc_chunks': None, 'max_open_inputs': 64}
+    for option in ['memory_budget', 'output_buffer']:
+        if config.has_option('Basics', option):
+            options[option] = config.getfloat('Basics', option)
+        # MB -> bytes
+        options[option] *= 1024 ** 2
+    if config.has_option('Basics', 'max_open_files'):
+        options['max_open_files'] = config.getint('Basics', 'max_open_files')
+    if config.has_option('Basics', 'max_open_inputs'):
+        options['max_open_inputs'] = config.getint('Basics',
+                                                   'max_open_inputs')
+    if config.has_option('Basics', 'prefetch'):
+        options['prefetch'] = config.getint('Basics', 'prefetch')
+    if config.has_option('Basics', 'nc_chunks'):
+        options['nc_chunks'] = tuple(
+            map(int, config.get('Basics', 'nc_chunks').split(',')))
+    if config.has_option('Basics', 'time_key'):
+        options['time_key'] = config.get('Basics', 'time_key')
+    if (config.has_option('Basics', 'start_date') or
+            config.has_option('Basics', 'end_date')):
+        start = datetime.datetime(datetime.MINYEAR, 1, 1)
+        end = datetime.datetime(datetime.MAXYEAR, 1, 1)
+        if config.has_option('Basics', 'start_date'):
+            start = parse_date(config.get('Basics', 'start_date'))
+        if config.has_option('Basics', 'end_date'):
+            end = parse_date(config.get('Basics', 'end_date'), end=True)
+        options['time_window'] = (start, end)
+    if config.has_option('Basics', 'bbox'):
+        bbox = map(float, config.get('Basics', 'bbox').split(','))
+        # longitudes are compared in -180 to 180
+        bbox[2:] = [lon - 360 if lon > 180 else lon for lon in bbox[2:]]
+        options['bbox'] = tuple(bbox)
+
     # Make list of files, from wild cards
     if (WC_Start and WC_End):
         nums = np.arange(WC_Start, WC_End+1)
@@ -126,7 +828,7 @@ def process_config(config_file):
             files.append(File_str.replace('**', str(i)))
 
     return (files, coord_keys, var_keys, output, binary_mult, binary_type,
-            paths, out_prefix, verbose)
+            paths, out_prefix, verbose, options)
 
 
 ###############################################################################
@@ -161,42 +863,196 @@ def read_netcdf(nc_file, nc_vars=[], coords=False, verbose=False):
 
 
 ###############################################################################
-def write_ASCII(array, point, out_prefix, path, append, verbose=False):
+def write_ASCII(array, point, out_prefix, path, append, verbose=False,
+                out=None):
     """
-    Write an array to standard VIC ASCII output.
+    Write an array to standard VIC ASCII output.  If out (an OutputManager)
+    is given, the data is buffered there instead of written directly.
     """
     fname = out_prefix+('%1.3f' % point[0])+'_'+('%1.3f' % point[1])
     out_file = os.path.join(path, fname)
+
+    if verbose:
+        print('Writing ASCII Data to'.format(out_file))
+    text = format_ascii(array, precision=4)
+    if out is not None:
+        out.write(out_file, text, append=append)
+        return
+
     if append:
         f = open(out_file, 'a')
     else:
         f = open(out_file, 'w')
-
-    if verbose:
-        print('Writing ASCII Data to'.format(out_file))
-    np.savetxt(f, array, fmt='%1.4f')
+    f.write(text)
     f.close()
 
 
+###############################################################################
+# digit tables for format_ascii, keyed by precision
+_DIGITS = {}
+
+
+def format_ascii(array, precision=4):
+    """
+    Format a (time, nvars) array as rows of '%1.<precision>f' values
+    separated by spaces, the same text as np.savetxt(f, array, fmt='%1.4f').
+
+    Values are rounded to scaled integers and their digits are placed in a
+    character buffer in one vectorized pass.  Values that are not finite,
+    large or too close to a rounding tie are formatted with '%' instead.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    if array.ndim == 1:
+        array = array.reshape(-1, 1)
+    if not array.size:
+        return ''
+    ncols = array.shape[1]
+    values = array.ravel()
+    scale = 10 ** precision
+
+    if precision not in _DIGITS:
+        digits = np.arange(scale)[:, None] // 10 ** np.arange(precision)[::-1]
+        _DIGITS[precision] = (digits % 10 + ord('0')).astype(np.uint8)
+
+    # scaled values below 1e10 are exact to ~1e-6, so rounding is exact
+    # unless the fraction is within 1e-5 of 0.5
+    with np.errstate(invalid='ignore'):
+        scaled = np.abs(values) * scale
+        fast = ((scaled < 1e10) &
+                (np.abs(scaled - np.floor(scaled) - 0.5) > 1e-5))
+    n = np.where(fast, np.rint(np.where(fast, scaled, 0)), 0).astype(np.int64)
+    whole, frac = np.divmod(n, scale)
+    ndigits = np.ones(len(values), dtype=np.int64)
+    for k in xrange(1, 11):
+        ndigits += whole >= 10 ** k
+    negative = np.signbit(values)
+    lengths = negative + ndigits + 1 + precision
+
+    slow = np.nonzero(~fast)[0]
+    slow_text = [('%1.{0}f'.format(precision)) % v for v in values[slow]]
+    lengths[slow] = [len(t) for t in slow_text]
+
+    # each value is followed by a space, or a newline at the end of a row
+    ends = np.cumsum(lengths + 1)
+    starts = ends - lengths - 1
+    buf = np.empty(ends[-1], dtype=np.uint8)
+    buf[ends - 1] = ord(' ')
+    buf[ends[ncols-1::ncols] - 1] = ord('\n')
+
+    idx = np.nonzero(fast)[0]
+    point = starts[idx] + negative[idx] + ndigits[idx]
+    buf[starts[idx][negative[idx]]] = ord('-')
+    buf[point] = ord('.')
+    buf[point[:, None] + np.arange(1, precision + 1)] = \
+        _DIGITS[precision][frac[idx]]
+    whole = whole[idx]
+    ndigits = ndigits[idx]
+    for k in xrange(ndigits.max() if len(idx) else 0):
+        sel = ndigits > k
+        buf[point[sel] - 1 - k] = (whole[sel] // 10 ** k) % 10 + ord('0')
+
+    for i, text in zip(slow, slow_text):
+        buf[starts[i]:starts[i] + len(text)] = np.frombuffer(text,
+                                                             dtype=np.uint8)
+    return buf.tobytes()
+
+
 ###############################################################################
 def write_binary(array, point, binary_type, out_prefix, path, append,
-                 verbose=False):
+                 verbose=False, out=None):
     """
-    Write a given array to standard binary short int format.
+    Write a given array to standard binary short int format.  If out (an
+    OutputManager) is given, the data is buffered there.
     """
     fname = out_prefix+('%.3f' % point[0])+'_'+('%.3f' % point[1])
     out_file = os.path.join(path, fname)
     if verbose:
         print('Writing Binary Data to'.format(out_file))
+
+    records, clipped = pack_binary(array, binary_dtype(binary_type))
+    if clipped:
+        print('WARNING: {0} values out of range for binary type {1} were '
+              'clipped in {2}'.format(clipped, binary_type, out_file))
+
+    if out is not None:
+        out.write(out_file, records.tobytes(), append=append)
+        return
+
     if append:
-        f = open(out_file, 'a')
+        f = open(out_file, 'ab')
     else:
-        f = open(out_file, 'w')
-
-    for row in array:
-        data = struct.pack(binary_type, *row)
-        f.write(data)
+        f = open(out_file, 'wb')
+    records.tofile(f)
     f.close()
 
+
+###############################################################################
+def binary_dtype(binary_type):
+    """
+    Return the numpy record dtype matching one row packed with the struct
+    format binary_type (e.g. 'Hhhh').
+    """
+    if binary_type and binary_type[0] in '@=<>!':
+        prefix, codes = binary_type[0], binary_type[1:]
+    else:
+        prefix, codes = '@', binary_type
+    byteorder = {'@': '=', '=': '=', '<': '<', '>': '>', '!': '>'}[prefix]
+
+    names = []
+    formats = []
+    offsets = []
+    expanded = ''
+    for count, code in re.findall(r'(\d*)(\D)', codes):
+        for i in range(int(count or 1)):
+            if code in 'bhilq':
+                kind = 'i'
+            elif code in 'BHILQ':
+                kind = 'u'
+            elif code in 'fd':
+                kind = 'f'
+            else:
+                raise ValueError('Unsupported binary type {0} in '
+                                 '{1}'.format(code, binary_type))
+            size = struct.calcsize(prefix + code)
+            expanded += code
+            names.append('f{0}'.format(len(names)))
+            formats.append('{0}{1}{2}'.format(byteorder, kind, size))
+            # struct aligns each field (native mode) but adds no end padding
+            offsets.append(struct.calcsize(prefix + expanded) - size)
+
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': struct.calcsize(binary_type)})
+
+
+###############################################################################
+def pack_binary(array, dtype):
+    """
+    Convert a (time, nvars) array to records of dtype in one pass.  Values
+    for integer fields are rounded and clipped to the range of the type.
+    Returns the records and the number of clipped (or non-finite) values.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    if array.ndim != 2 or array.shape[1] != len(dtype.names):
+        raise ValueError('array shape {0} does not match binary type with '
+                         '{1} fields'.format(array.shape, len(dtype.names)))
+
+    records = np.zeros(array.shape[0], dtype=dtype)
+    clipped = 0
+    for j, name in enumerate(dtype.names):
+        field_type = dtype.fields[name][0]
+        column = array[:, j]
+        if field_type.kind in 'iu':
+            info = np.iinfo(field_type)
+            column = np.round(column)
+            invalid = ~np.isfinite(column)
+            column[invalid] = 0
+            clipped += invalid.sum() + ((column < info.min) |
+                                        (column > info.max)).sum()
+            column = np.clip(column, info.min, info.max)
+        records[name] = column
+
+    return records, clipped
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""
+Remap gridded fields from a regular lat/lon grid to a target (domain) grid
+
+Bilinear and first order conservative weights are computed once as sparse
+matrices (target cells x source cells) and applied to all time steps of a
+field with one sparse matrix product.  Weights can be cached to disk, keyed
+by hashes of the source and target grids.
+
+Conservative overlaps are computed in (lon, sin(lat)) coordinates, where the
+area of the source (lat/lon) cells is exact.  Target cells are the polygons
+given by their corners (e.g. xv/yv in a domain file).  Target cells that
+contain a pole can't be described in lon/lat and use bilinear weights.
+"""
+import hashlib
+import os
+import numpy as np
+from netCDF4 import Dataset
+from scipy import sparse
+
+METHODS = ['bilinear', 'conservative']
+
+# weights used in this process, keyed by the cache file name
+_WEIGHTS = {}
+
+
+# -------------------------------------------------------------------- #
+def read_domain(domain_file, lat_key='yc', lon_key='xc', lat_bounds_key='yv',
+                lon_bounds_key='xv', mask_key='mask'):
+    """
+    Read the target grid from a domain file, returns a dict with the 2d lat
+    and lon arrays, the corners (or None if the file has none) and the mask.
+    """
+    f = Dataset(domain_file, 'r')
+    domain = {'lat': f.variables[lat_key][:], 'lon': f.variables[lon_key][:],
+              'lat_bounds': None, 'lon_bounds': None, 'mask': None}
+    if lat_bounds_key in f.variables and lon_bounds_key in f.variables:
+        domain['lat_bounds'] = f.variables[lat_bounds_key][:]
+        domain['lon_bounds'] = f.variables[lon_bounds_key][:]
+    if mask_key in f.variables:
+        domain['mask'] = f.variables[mask_key][:]
+    f.close()
+    for key, value in domain.iteritems():
+        if value is not None:
+            domain[key] = np.ma.filled(np.ma.asarray(value, np.float64),
+                                       np.nan)
+    return domain
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def grid_hash(*arrays):
+    """Return a sha1 hash of the shapes and values of arrays"""
+    sha = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            sha.update('None')
+            continue
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        sha.update(str(array.shape))
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def get_weights(method, src_lats, src_lons, dst, cache_dir=None):
+    """
+    Return the (target cells x source cells) weights of method from the
+    source grid (1d lats and lons) to the dst grid (a dict from read_domain).
+    Weights are read from / written to cache_dir if it is given.
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown remapping method {0}, expected one of '
+                         '{1}'.format(method, METHODS))
+    src_hash = grid_hash(src_lats, src_lons)
+    dst_hash = grid_hash(dst['lat'], dst['lon'], dst['lat_bounds'],
+                         dst['lon_bounds'])
+    name = 'weights_{0}_{1}_{2}.npz'.format(method, src_hash[:16],
+                                            dst_hash[:16])
+    if name in _WEIGHTS:
+        return _WEIGHTS[name]
+
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, name)
+    if cache_file and os.path.isfile(cache_file):
+        weights = sparse.load_npz(cache_file)
+    else:
+        if method == 'bilinear':
+            weights = bilinear_weights(src_lats, src_lons, dst['lat'],
+                                       dst['lon'])
+        else:
+            if dst['lat_bounds'] is None:
+                raise ValueError('Conservative remapping needs the corners of '
+                                 'the target cells')
+            weights = conservative_weights(src_lats, src_lons, dst['lat'],
+                                           dst['lon'], dst['lat_bounds'],
+                                           dst['lon_bounds'])
+        if cache_file:
+            # other processes may be reading the cache, so write it to a
+            # temporary name and move it into place
+            tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                sparse.save_npz(f, weights)
+            os.rename(tmp_file, cache_file)
+    _WEIGHTS[name] = weights
+    return weights
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def remap(weights, data, shape):
+    """
+    Remap data (time, y, x) on the source grid with weights, returns a
+    (time, ) + shape masked array.  Masked (or NaN) source values are left
+    out and the weights of each target cell renormalized, target cells with
+    no valid source values are masked.
+    """
+    data = np.ma.asarray(data, dtype=np.float64)
+    nt = data.shape[0]
+    values = np.ma.filled(data, np.nan).reshape(nt, -1).T
+    valid = np.isfinite(values)
+    values[~valid] = 0
+
+    out = np.asarray(weights.dot(values))
+    if valid.all():
+        norm = np.asarray(weights.sum(axis=1))
+    elif (valid == valid[:, :1]).all():
+        # same mask for all steps
+        norm = weights.dot(valid[:, :1].astype(np.float64))
+    else:
+        norm = weights.dot(valid.astype(np.float64))
+    norm = np.broadcast_to(norm, out.shape)
+    missing = norm < 1e-10
+    out[~missing] /= norm[~missing]
+    out = np.ma.masked_array(out, mask=missing)
+    return out.T.reshape((nt, ) + tuple(shape))
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _axis(centers, name):
+    """Return the centers in increasing order and the order used"""
+    centers = np.asarray(centers, dtype=np.float64)
+    if centers.ndim != 1 or len(centers) < 2:
+        raise ValueError('{0} must be 1d with at least 2 values'.format(name))
+    order = np.argsort(centers)
+    centers = centers[order]
+    if not (np.diff(centers) > 0).all():
+        raise ValueError('{0} has repeated values'.format(name))
+    return centers, order
+
+
+def _edges(centers):
+    """Return the cell edges of 1d cell centers (midpoints)"""
+    mid = 0.5 * (centers[1:] + centers[:-1])
+    return np.concatenate(([2 * centers[0] - mid[0]], mid,
+                           [2 * centers[-1] - mid[-1]]))
+
+
+def _is_global(lon_edges):
+    return abs(lon_edges[-1] - lon_edges[0] - 360) < 1e-6
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def bilinear_weights(src_lats, src_lons, dst_lats, dst_lons):
+    """
+    Return the bilinear weights from the source grid (1d lats and lons) to
+    the target points (arrays of lats and lons).  Targets outside the source
+    grid get no weights.
+    """
+    lats, lat_order = _axis(src_lats, 'source lats')
+    lons, lon_order = _axis(src_lons, 'source lons')
+    ny, nx = len(lats), len(lons)
+    dst_lats = np.asarray(dst_lats, dtype=np.float64).ravel()
+    dst_lons = np.asarray(dst_lons, dtype=np.float64).ravel()
+
+    wrap = _is_global(_edges(lons))
+    x = dst_lons.copy()
+    if wrap:
+        lons = np.append(lons, lons[0] + 360)
+        x = lons[0] + np.mod(x - lons[0], 360)
+    else:
+        # try the target longitudes shifted by 360 degrees
+        for shift in [-360, 360]:
+            out = (x < lons[0]) | (x > lons[-1])
+            x[out] += shift
+            x[out & ((x < lons[0]) | (x > lons[-1]))] -= shift
+
+    i = np.clip(np.searchsorted(lats, dst_lats, side='right') - 1, 0, ny - 2)
+    j = np.clip(np.searchsorted(lons, x, side='right') - 1, 0,
+                len(lons) - 2)
+    wy = (dst_lats - lats[i]) / (lats[i+1] - lats[i])
+    wx = (x - lons[j]) / (lons[j+1] - lons[j])
+    inside = ((wy >= -1e-9) & (wy <= 1 + 1e-9) & (wx >= -1e-9) &
+              (wx <= 1 + 1e-9))
+    wy = np.clip(wy, 0, 1)
+    wx = np.clip(wx, 0, 1)
+
+    j1 = j + 1
+    if wrap:
+        j1 = j1 % nx
+    rows = []
+    cols = []
+    vals = []
+    for ii, jj, w in [(i, j, (1 - wy) * (1 - wx)), (i, j1, (1 - wy) * wx),
+                      (i + 1, j, wy * (1 - wx)), (i + 1, j1, wy * wx)]:
+        rows.append(np.nonzero(inside)[0])
+        cols.append(lat_order[ii[inside]] * nx + lon_order[jj[inside]])
+        vals.append(w[inside])
+    weights = sparse.csr_matrix((np.concatenate(vals),
+                                 (np.concatenate(rows),
+                                  np.concatenate(cols))),
+                                shape=(len(dst_lats), ny * nx))
+    weights.eliminate_zeros()
+    return weights
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def conservative_weights(src_lats, src_lons, dst_lats, dst_lons,
+                         dst_lat_bounds, dst_lon_bounds, batch=20000):
+    """
+    Return first order conservative weights from the source grid (1d lats
+    and lons of the cell centers) to the target cells, given by their
+    centers (arrays of lats and lons) and corners (the same shape plus a
+    corner dimension).  The weight of a source cell is the fraction of the
+    target cell's area that it covers.
+    """
+    lats, lat_order = _axis(src_lats, 'source lats')
+    lons, lon_order = _axis(src_lons, 'source lons')
+    ny, nx = len(lats), len(lons)
+    lat_edges = np.clip(_edges(lats), -90, 90)
+    lon_edges = _edges(lons)
+    wrap = _is_global(lon_edges)
+    if wrap:
+        # three periods, column k is source column k % nx
+        lon_edges = np.concatenate((lon_edges[:-1] - 360, lon_edges[:-1],
+                                    lon_edges + 360))
+    y_edges = np.sin(np.radians(lat_edges))
+
+    ndst = np.size(dst_lats)
+    nv = np.shape(dst_lat_bounds)[-1]
+    corner_lats = np.asarray(dst_lat_bounds, dtype=np.float64).reshape(-1, nv)
+    corner_lons = np.asarray(dst_lon_bounds, dtype=np.float64).reshape(-1, nv)
+
+    # unwrap the corners around the first one and move the cell to the
+    # first period of the source longitudes
+    corner_lons = corner_lons[:, :1] + np.mod(
+        corner_lons - corner_lons[:, :1] + 180, 360) - 180
+    west = corner_lons.min(axis=1) - lon_edges[len(lon_edges) // 3 if wrap
+                                               else 0]
+    corner_lons += (np.mod(west, 360) - west)[:, None]
+    polar = ((corner_lons.max(axis=1) - corner_lons.min(axis=1) > 180) |
+             ~np.isfinite(corner_lats).all(axis=1) |
+             ~np.isfinite(corner_lons).all(axis=1))
+
+    rows = []
+    cols = []
+    vals = []
+    for start in xrange(0, ndst, batch):
+        cells = np.arange(start, min(start + batch, ndst))
+        cells = cells[~polar[cells]]
+        if not len(cells):
+            continue
+        px = corner_lons[cells]
+        py = np.sin(np.radians(np.clip(corner_lats[cells], -90, 90)))
+        area = _polygon_area(np.dstack((px, py)), np.full(len(cells), nv))
+
+        # candidate source cells in the bounding box of each target cell
+        r0 = np.clip(np.searchsorted(y_edges, py.min(axis=1), 'right') - 1,
+                     0, ny - 1)
+        r1 = np.clip(np.searchsorted(y_edges, py.max(axis=1), 'left') - 1,
+                     0, ny - 1)
+        c0 = np.clip(np.searchsorted(lon_edges, px.min(axis=1), 'right') - 1,
+                     0, len(lon_edges) - 2)
+        c1 = np.clip(np.searchsorted(lon_edges, px.max(axis=1), 'left') - 1,
+                     0, len(lon_edges) - 2)
+        nr = r1 - r0 + 1
+        nc = c1 - c0 + 1
+        counts = nr * nc
+        pair = np.repeat(np.arange(len(cells)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+                                                    counts, counts)
+        r = r0[pair] + local // nc[pair]
+        c = c0[pair] + local % nc[pair]
+
+        polys = np.dstack((px, py))[pair]
+        nvert = np.full(len(pair), nv)
+        for axis, bound, sign in [(0, lon_edges[c], 1),
+                                  (0, lon_edges[c+1], -1),
+                                  (1, y_edges[r], 1),
+                                  (1, y_edges[r+1], -1)]:
+            polys, nvert = _clip(polys, nvert, axis, bound, sign)
+        overlap = _polygon_area(polys, nvert)
+
+        frac = overlap / area[pair]
+        keep = frac > 1e-12
+        rows.append(cells[pair[keep]])
+        if wrap:
+            c = c % nx
+        cols.append(lat_order[r[keep]] * nx + lon_order[c[keep]])
+        vals.append(frac[keep])
+
+    weights = sparse.csr_matrix((np.concatenate(vals) if vals else [],
+                                 (np.concatenate(rows) if rows else [],
+                                  np.concatenate(cols) if cols else [])),
+                                shape=(ndst, ny * nx))
+    if polar.any():
+        bilinear = bilinear_weights(src_lats, src_lons, dst_lats, dst_lons)
+        weights = weights + sparse.diags(polar.astype(np.float64)).dot(
+            bilinear)
+        weights = weights.tocsr()
+    return weights
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _clip(polys, nvert, axis, bound, sign):
+    """
+    Clip convex polygons (n, vertices, 2) with nvert valid vertices to the
+    half planes sign * (coordinate[axis] - bound) >= 0 (Sutherland-Hodgman).
+    """
+    n, m = polys.shape[:2]
+    k = np.arange(m)
+    valid = k < nvert[:, None]
+    nxt = np.where(k + 1 < nvert[:, None], k + 1, 0)
+    rows = np.arange(n)[:, None]
+    following = polys[rows, nxt]
+
+    # unused vertex slots may hold NaNs
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = sign * (polys[:, :, axis] - bound[:, None])
+        dist_next = sign * (following[:, :, axis] - bound[:, None])
+        inside = dist >= 0
+        inside_next = dist_next >= 0
+        t = dist / (dist - dist_next)
+        cross = polys + t[:, :, None] * (following - polys)
+
+    out = np.empty((n, 2 * m, 2))
+    out[:, 0::2] = polys
+    out[:, 1::2] = cross
+    keep = np.empty((n, 2 * m), dtype=bool)
+    keep[:, 0::2] = valid & inside
+    keep[:, 1::2] = valid & (inside != inside_next)
+
+    nvert = keep.sum(axis=1)
+    order = np.argsort(~keep, axis=1, kind='mergesort')
+    size = max(nvert.max(), 1) if n else 1
+    return out[rows, order[:, :size]], nvert
+
+
+def _polygon_area(polys, nvert):
+    """Return the areas of polygons (n, vertices, 2) with nvert vertices"""
+    n, m = polys.shape[:2]
+    k = np.arange(m)
+    nxt = np.where(k + 1 < nvert[:, None], k + 1, 0)
+    following = polys[np.arange(n)[:, None], nxt]
+    cross = (polys[:, :, 0] * following[:, :, 1] -
+             following[:, :, 0] * polys[:, :, 1])
+    cross[k >= nvert[:, None]] = 0
+    return 0.5 * np.abs(cross.sum(axis=1))
+# -------------------------------------------------------------------- #
@@ -6,7 +6,13 @@ A toolkit for converting classic vic parameters to netcdf format
 """
 
 from __future__ import print_function
+import os
+import re
 import sys
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 from netCDF4 import Dataset, default_fillvals
 from scipy.spatial import cKDTree
@@ -16,6 +22,7 @@ import argparse
 import socket
 from getpass import getuser
 from collections import OrderedDict
+from io import BytesIO
 
 # -------------------------------------------------------------------- #
 # precision
@@ -33,6 +40,9 @@ FILLVALUE_I = default_fillvals[NC_INT]
 XVAR = 'xc'
 YVAR = 'yc'
 
+# bytes of text parsed at a time by read_columns
+BLOCK_SIZE = 64 * 1024 * 1024
+
 # -------------------------------------------------------------------- #
 
 
@@ -430,13 +440,17 @@ def main():
     all the parameterfiles (default name is params.nc)
     """
     grid_file, soil_file, snow_file, veg_file, \
-        vegl_file, out_file, version = process_command_line()
+        vegl_file, out_file, version, processes, \
+        cache_dir, nc_options = process_command_line()
     grids = make_grid(grid_file, soil_file,
                       snow_file=snow_file,
                       veg_file=veg_file,
                       vegl_file=vegl_file,
                       nc_file=out_file,
-                      version=version)
+                      version=version,
+                      processes=processes,
+                      cache_dir=cache_dir,
+                      nc_options=nc_options)
 
     print('completed grid_parms.main(), output file was: {0}'.format(out_file))
 # -------------------------------------------------------------------- #
@@ -486,8 +500,66 @@ def process_command_line():
                         choices=['4.1.2', '5.0.dev'],
                         default='params.nc')
 
+    parser.add_argument("-n", "--processes",
+                        type=int,
+                        help="Number of processes used to parse the "
+                             "parameter files concurrently, (default=1)",
+                        default=1)
+
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        help="Directory to cache the parsed soil file in, "
+                             "(default=None)",
+                        default=None)
+
+    parser.add_argument("--nc_type",
+                        type=str,
+                        help="netCDF type of the parameter variables, "
+                             "(default=f8)",
+                        choices=[NC_DOUBLE, NC_FLOAT],
+                        default=NC_DOUBLE)
+
+    parser.add_argument("--var_type",
+                        type=str,
+                        help="netCDF type of a single variable as VAR=TYPE, "
+                             "may be repeated (e.g. --var_type LAI=f4)",
+                        action='append',
+                        default=[])
+
+    parser.add_argument("--zlib",
+                        action='store_true',
+                        help="Compress the parameter variables with zlib")
+
+    parser.add_argument("--complevel",
+                        type=int,
+                        help="zlib compression level, (default=4)",
+                        default=4)
+
+    parser.add_argument("--no_shuffle",
+                        action='store_true',
+                        help="Do not use the HDF5 shuffle filter")
+
+    parser.add_argument("--chunks",
+                        type=int,
+                        nargs=2,
+                        help="Chunk size (ny nx) of the gridded variables",
+                        default=None)
+
     args = parser.parse_args()
 
+    var_types = {}
+    for var_type in args.var_type:
+        parts = var_type.split('=')
+        if len(parts) != 2 or not parts[0]:
+            parser.error('argument --var_type: expected VAR=TYPE, got '
+                         '{0!r}'.format(var_type))
+        if parts[1] not in default_fillvals:
+            parser.error('argument --var_type: unknown netCDF type {0!r} for '
+                         '{1} (choose from {2})'.format(
+                             parts[1], parts[0],
+                             ', '.join(sorted(default_fillvals))))
+        var_types[parts[0]] = parts[1]
+
     grid_file = args.grid_file
     soil_file = args.soil_file
     snow_file = args.snow_file
@@ -495,42 +567,75 @@ def process_command_line():
     vegl_file = args.vegl_file
     out_file = args.out_file
     version = args.version
+    processes = args.processes
+    cache_dir = args.cache_dir
+    nc_options = {'nc_type': args.nc_type,
+                  'var_types': var_types,
+                  'zlib': args.zlib,
+                  'complevel': args.complevel,
+                  'shuffle': not args.no_shuffle,
+                  'chunks': args.chunks}
 
     return (grid_file, soil_file, snow_file, veg_file, vegl_file, out_file,
-            version)
+            version, processes, cache_dir, nc_options)
 # -------------------------------------------------------------------- #
 
 
 # -------------------------------------------------------------------- #
 def make_grid(grid_file, soil_file, snow_file, veg_file, vegl_file,
-              nc_file='params.nc', version='4.1.2'):
+              nc_file='params.nc', version='4.1.2', processes=1,
+              cache_dir=None, nc_options=None):
     """
     Make grid uses routines from params.py to read standard vic format
     parameter files.  After the parameter files are read, the files are placed
     onto the target grid using nearest neighbor mapping.  If a land mask is
     present in the target grid it will be used to exclude areas in the ocean.
     Finally, if the nc_file = 'any_string.nc', a netcdf file be written with
-    the parameter data, if nc_file = False, the dictionary of grids is
-    returned.
+    the parameter data (nc_options are passed to write_netcdf), if
+    nc_file = False, the dictionary of grids is returned.
     """
     print('making grided parameters now...')
 
-    soil_dict = soil(soil_file)
-
-    if snow_file:
-        snow_dict = snow(snow_file, soil_dict)
+    if processes > 1 and (snow_file or veg_file or vegl_file):
+        # parse the files concurrently, the reordering to the soil gridcells
+        # has to wait for the soil file
+        jobs = OrderedDict([('soil', (soil, (soil_file, ),
+                                      {'cache_dir': cache_dir}))])
+        if snow_file:
+            jobs['snow'] = (snow, (snow_file, None), {})
+        if veg_file:
+            jobs['veg'] = (veg, (veg_file, None), {'LAIindex': True})
+        if vegl_file:
+            jobs['veglib'] = (veg_class, (vegl_file, ), {})
+        dicts = read_parallel(jobs, processes, tmp_dir=cache_dir)
+
+        soil_dict = dicts['soil']
+        if snow_file:
+            snow_dict = reorder_snow(dicts['snow'], soil_dict)
+        else:
+            snow_dict = False
+        if veg_file:
+            veg_dict = reorder_veg(dicts['veg'], soil_dict)
+        else:
+            veg_dict = False
+        veglib_dict = dicts.get('veglib', False)
     else:
-        snow_dict = False
+        soil_dict = soil(soil_file, processes=processes, cache_dir=cache_dir)
 
-    if veg_file:
-        veg_dict = veg(veg_file, soil_dict, LAIindex=True)
-    else:
-        veg_dict = False
+        if snow_file:
+            snow_dict = snow(snow_file, soil_dict)
+        else:
+            snow_dict = False
 
-    if vegl_file:
-        veglib_dict = veg_class(vegl_file)
-    else:
-        veglib_dict = False
+        if veg_file:
+            veg_dict = veg(veg_file, soil_dict, LAIindex=True)
+        else:
+            veg_dict = False
+
+        if vegl_file:
+            veglib_dict = veg_class(vegl_file)
+        else:
+            veglib_dict = False
 
     if grid_file:
         target_grid, target_attrs = read_netcdf(grid_file)
@@ -538,23 +643,75 @@ def make_grid(grid_file, soil_file, snow_file, veg_file, vegl_file,
         target_grid, target_attrs = calc_grid(soil_dict['lats'],
                                               soil_dict['lons'])
 
-    grid_dict = grid_params(soil_dict, target_grid, snow_dict=snow_dict,
-                            veg_dict=veg_dict, veglib_dict=veglib_dict,
-                            version=version)
-
     if nc_file:
+        # grid and write one variable at a time
+        grids = iter_grid_params(soil_dict, target_grid, snow_dict=snow_dict,
+                                 veg_dict=veg_dict, veglib_dict=veglib_dict,
+                                 version=version)
+        if nc_options is None:
+            nc_options = {}
         write_netcdf(nc_file, target_attrs,
                      target_grid=target_grid,
-                     soil_grid=grid_dict['soil_dict'],
-                     snow_grid=grid_dict['snow_dict'],
                      veglib_dict=veglib_dict,
-                     veg_grid=grid_dict['veg_dict'],
-                     version=version)
+                     version=version,
+                     grids=grids,
+                     **nc_options)
+        return
+
+    grid_dict = grid_params(soil_dict, target_grid, snow_dict=snow_dict,
+                            veg_dict=veg_dict, veglib_dict=veglib_dict,
+                            version=version)
 
     return grid_dict
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+def read_parallel(jobs, processes, tmp_dir=None):
+    """
+    Run the parameter file readers in jobs, {name: (func, args, kwargs)}, in
+    a process pool.  Each reader returns a dictionary of arrays that is passed
+    back through .npy files in a temporary directory (in tmp_dir if given).
+    Returns {name: dictionary}.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='grid_params_', dir=tmp_dir)
+    pool = multiprocessing.Pool(processes=min(processes, len(jobs)))
+    try:
+        results = OrderedDict()
+        for name, (func, args, kwargs) in jobs.iteritems():
+            prefix = os.path.join(tmp_dir, name)
+            results[name] = pool.apply_async(save_dict,
+                                             (prefix, func, args, kwargs))
+        pool.close()
+
+        dicts = OrderedDict()
+        for name, result in results.iteritems():
+            dicts[name] = OrderedDict()
+            for var, npy_file in result.get():
+                dicts[name][var] = np.load(npy_file)
+                os.remove(npy_file)
+        pool.join()
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmp_dir)
+
+    return dicts
+
+
+def save_dict(prefix, func, args, kwargs):
+    """
+    Call func(*args, **kwargs) and save each array of the dictionary it
+    returns as a .npy file.  Returns the [(var, npy_file), ...] list.
+    """
+    files = []
+    for i, (var, data) in enumerate(func(*args, **kwargs).iteritems()):
+        npy_file = '{0}_{1}.npy'.format(prefix, i)
+        np.save(npy_file, data)
+        files.append((var, npy_file))
+    return files
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def calc_grid(lats, lons, decimals=4):
     """ determine shape of regular grid from lons and lats"""
@@ -665,127 +822,179 @@ def grid_params(soil_dict, target_grid, snow_dict, veg_dict, veglib_dict,
     maps all input dictionaries to the target grid.  Returns a grid_dict with
     the mapped input dictionary data.
     """
+    out_dicts = OrderedDict([('soil_dict', OrderedDict()),
+                             ('snow_dict', False),
+                             ('veg_dict', False)])
+
+    for name, var, data in iter_grid_params(soil_dict, target_grid,
+                                            snow_dict, veg_dict, veglib_dict,
+                                            version=version):
+        if not out_dicts[name]:
+            out_dicts[name] = OrderedDict()
+        if isinstance(data, BroadcastGrid):
+            data = data[:].copy()
+        out_dicts[name][var] = data
+
+    return out_dicts
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def iter_grid_params(soil_dict, target_grid, snow_dict, veg_dict,
+                     veglib_dict, version='4.1.2'):
+    """
+    Map the input dictionaries to the target grid one variable at a time.
+    Yields (dict name, var, gridded data) so each variable can be written and
+    released before the next one is gridded.
+    """
     print('gridding params now...')
 
     yi, xi = latlon2yx(soil_dict['lats'], soil_dict['lons'],
                        target_grid[YVAR], target_grid[XVAR])
 
-    in_dicts = {'soil_dict': soil_dict}
-    out_dicts = OrderedDict()
-    if snow_dict:
-        in_dicts['snow_dict'] = snow_dict
-    else:
-        out_dicts['snow_dict'] = False
-    if veg_dict:
-        in_dicts['veg_dict'] = veg_dict
-    else:
-        out_dicts['veg_dict'] = False
-
     # get "unmasked" mask
     mask = target_grid['mask']
 
-    ysize, xsize = target_grid['mask'].shape
-
-    ymask, xmask = np.nonzero(mask != 1)
+    ocean = mask != 1
 
-    print('{0} masked values'.format(len(ymask)))
+    print('{0} masked values'.format(ocean.sum()))
 
-    for name, mydict in in_dicts.iteritems():
-        out_dict = OrderedDict()
+    vic5 = veg_dict and veglib_dict and version == '5.0.dev'
 
+    for name, mydict in [('soil_dict', soil_dict), ('snow_dict', snow_dict),
+                         ('veg_dict', veg_dict)]:
+        if not mydict:
+            continue
         for var in mydict:
-            if mydict[var].dtype in [np.int, np.int64, np.int32]:
-                fill_val = FILLVALUE_I
-                dtype = np.int
-            else:
-                fill_val = FILLVALUE_F
-                dtype = np.float
-
-            if mydict[var].ndim == 1:
-                out_dict[var] = np.ma.zeros((ysize, xsize),
-                                            dtype=dtype)
-                out_dict[var][yi, xi] = mydict[var]
-                out_dict[var][ymask, xmask] = fill_val
-
-            elif mydict[var].ndim == 2:
-                steps = mydict[var].shape[1]
-                out_dict[var] = np.ma.zeros((steps, ysize, xsize),
-                                            dtype=dtype)
-                for i in xrange(steps):
-                    out_dict[var][i, yi, xi] = mydict[var][:, i]
-                out_dict[var][:, ymask, xmask] = fill_val
-
-            elif mydict[var].ndim == 3:
-                j = mydict[var].shape[1]
-                k = mydict[var].shape[2]
-                out_dict[var] = np.ma.zeros((j, k, ysize, xsize),
-                                            dtype=dtype)
-                for jj in xrange(j):
-                    for kk in xrange(k):
-                        out_dict[var][jj, kk, yi, xi] = mydict[var][:, jj, kk]
-                for y, x in zip(ymask, xmask):
-                    out_dict[var][:, :, y, x] = fill_val
-
-            out_dict[var] = np.ma.masked_values(out_dict[var], fill_val)
-
-        out_dicts[name] = out_dict
-
-    if veglib_dict and version == '5.0.dev':
-        # adjust vars for the following conditions
-        # bare soil tile
-
-        # Add bare soil tile
-        var = 'Cv'
-        bare = 1 - out_dicts['veg_dict'][var].sum(axis=0)
-        bare[bare < 0.0] = 0.0
-        nveg_clases = out_dicts['veg_dict'][var].shape[0] + 1
-        shape = (nveg_clases, ) + out_dicts['veg_dict'][var].shape[1:]
-        new = np.zeros(shape)
-        new[:-1, :, :] = out_dicts['veg_dict'][var]
-        new[-1, :, :] = bare
+            data = grid_variable(mydict[var], yi, xi, ocean)
+            if vic5 and name == 'veg_dict':
+                data = add_bare_soil(var, data, ocean)
+            yield name, var, data
+            del data
+
+    if vic5:
+        nveg_classes = veg_dict['Cv'].shape[-1] + 1
+        for var, data in grid_veglib(veglib_dict, nveg_classes, yi, xi,
+                                     ocean):
+            yield 'veg_dict', var, data
+            del data
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def add_bare_soil(var, data, ocean):
+    """
+    Add the bare soil tile to the gridded veg variables (for VIC 5.0.dev)
+    """
+    if var not in ['Cv', 'root_depth', 'root_fract', 'LAI']:
+        return data
+
+    shape = (data.shape[0] + 1, ) + data.shape[1:]
+    new = np.empty(shape)
+    new[:-1] = data.data
+    mask = np.zeros(shape, dtype=bool)
+
+    if var == 'Cv':
+        # bare soil fraction, then normalize all tiles in place
+        bare = new[-1]
+        np.sum(new[:-1], axis=0, out=bare)
+        np.subtract(1, bare, out=bare)
+        np.maximum(bare, 0.0, out=bare)
         new /= new.sum(axis=0)
-        new[:, ymask, xmask] = FILLVALUE_F
-        out_dicts['veg_dict'][var] = new
-
-        # add dummy values for other veg vars
-        #   double root_depth(veg_class, root_zone, nj, ni) ;
-        #   double root_fract(veg_class, root_zone, nj, ni) ;
-        #   double LAI(veg_class, month, nj, ni) ;
-        for var in ['root_depth', 'root_fract', 'LAI']:
-            shape = (nveg_clases, ) + out_dicts['veg_dict'][var].shape[1:]
-            new = np.zeros(shape) + FILLVALUE_F
-            new[:-1, :, :] = out_dicts['veg_dict'][var]
-            new[-1, :, :] = 0
-            out_dicts['veg_dict'][var] = np.ma.masked_values(new, FILLVALUE_F)
-
-        # Distribute the veglib variables
-        # 1st - the 1d vars
-        #   double lib_overstory(veg_class) ;  --> (veg_class, nj, ni)
-        for var in ['overstory', 'rarc', 'rmin', 'wind_h', 'RGL', 'rad_atten',
-                    'rad_atten', 'wind_atten', 'trunk_ratio', 'snow_albedo']:
-            lib_var = 'lib_{0}'.format(var)
-            new = np.zeros((nveg_clases, ysize, xsize)) + FILLVALUE_F
-            new[:-1, yi, xi] = veglib_dict[lib_var][:, np.newaxis]
-            new[-1, yi, xi] = 0
-            new[:, ymask, xmask] = fill_val
-            out_dicts['veg_dict'][var] = np.ma.masked_values(new, FILLVALUE_F)
-
-        # 2nd - the 2d vars
-        for var in ['albedo', 'veg_rough', 'displacement']:
-            lib_var = 'lib_{0}'.format(var)
-            shape = (nveg_clases, veglib_dict[lib_var].shape[1], ysize, xsize)
-            new = np.zeros(shape) + FILLVALUE_F
-            new[:-1, :, yi, xi] = veglib_dict[lib_var][:, :, np.newaxis]
-            new[-1, :, yi, xi] = 0
-            for y, x in zip(ymask, xmask):
-                new[:, :, y, x] = fill_val
-            out_dicts['veg_dict'][var] = np.ma.masked_values(new, FILLVALUE_F)
-
-        # 3rd - remove the redundant vars
-        #   double lib_LAI(veg_class, month) ;
-        # removed from file
+        new[:, ocean] = FILLVALUE_F
+        mask[:, ocean] = True
+
+    # add dummy values for other veg vars
+    #   double root_depth(veg_class, root_zone, nj, ni) ;
+    #   double root_fract(veg_class, root_zone, nj, ni) ;
+    #   double LAI(veg_class, month, nj, ni) ;
+    else:
+        new[-1] = 0
+        mask[:-1] = np.ma.getmaskarray(data)
+    del data
+
+    return np.ma.masked_array(new, mask=mask, fill_value=FILLVALUE_F)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class BroadcastGrid(object):
+    """
+    Read only (nveg_classes, [month, ] ny, nx) grid holding the veglib value
+    of each class in every cell where land is True.  It is a broadcast view
+    of the library values, indexing it returns masked array views so no
+    array of the full grid size is allocated.
+    """
+    def __init__(self, values, land):
+        self.shape = values.shape + land.shape
+        self.ndim = len(self.shape)
+        self.dtype = values.dtype
+        self._data = np.broadcast_to(values.reshape(values.shape + (1, 1)),
+                                     self.shape)
+        self._mask = np.broadcast_to(~land, self.shape)
+
+    def __getitem__(self, index):
+        return np.ma.masked_array(self._data[index], mask=self._mask[index],
+                                  fill_value=FILLVALUE_F)
+# -------------------------------------------------------------------- #
+
 
-    return out_dicts
+# -------------------------------------------------------------------- #
+def grid_veglib(veglib_dict, nveg_classes, yi, xi, ocean):
+    """
+    Distribute the veglib variables to every grid cell (for VIC 5.0.dev),
+    yields (var, BroadcastGrid)
+    """
+    land = np.zeros(ocean.shape, dtype=bool)
+    land[yi, xi] = True
+    land[ocean] = False
+
+    # 1st - the 1d vars
+    #   double lib_overstory(veg_class) ;  --> (veg_class, nj, ni)
+    # 2nd - the 2d vars
+    #   double lib_albedo(veg_class, month) ;  --> (veg_class, month, nj, ni)
+    for var in ['overstory', 'rarc', 'rmin', 'wind_h', 'RGL', 'rad_atten',
+                'wind_atten', 'trunk_ratio', 'snow_albedo', 'albedo',
+                'veg_rough', 'displacement']:
+        lib_var = 'lib_{0}'.format(var)
+        values = np.zeros((nveg_classes, ) + veglib_dict[lib_var].shape[1:])
+        values[:-1] = veglib_dict[lib_var]
+        yield var, BroadcastGrid(values, land)
+
+    # 3rd - remove the redundant vars
+    #   double lib_LAI(veg_class, month) ;
+    # removed from file
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def grid_variable(data, yi, xi, ocean):
+    """
+    Map data (cells, ...) to a masked array (..., ysize, xsize) with a single
+    fancy-index assignment.  The mask is ocean plus any cells where data is
+    already the fill value.
+    """
+    if data.dtype in [np.int, np.int64, np.int32]:
+        fill_val = FILLVALUE_I
+        dtype = np.int
+    else:
+        fill_val = FILLVALUE_F
+        dtype = np.float
+
+    shape = data.shape[1:] + ocean.shape
+    values = np.moveaxis(data, 0, -1)
+
+    grid = np.zeros(shape, dtype=dtype)
+    grid[..., yi, xi] = values
+    grid[..., ocean] = fill_val
+
+    grid_mask = np.empty(shape, dtype=bool)
+    grid_mask[...] = ocean
+    missing = values == fill_val
+    if missing.any():
+        grid_mask[..., yi, xi] |= missing
+
+    return np.ma.masked_array(grid, mask=grid_mask, fill_value=fill_val)
 # -------------------------------------------------------------------- #
 
 
@@ -835,12 +1044,19 @@ def read_netcdf(nc_file, variables=[], coords=False, verbose=True):
 #  Write output to netCDF
 def write_netcdf(myfile, target_attrs, target_grid,
                  soil_grid=None, snow_grid=None, veg_grid=None,
-                 veglib_dict=None, version='4.1.2'):
+                 veglib_dict=None, version='4.1.2', grids=None,
+                 nc_type=NC_DOUBLE, var_types=None, zlib=False, complevel=4,
+                 shuffle=True, chunks=None):
     """
     Write the gridded parameters to a netcdf4 file
     Will only write paramters that it is given
     Reads attributes from params.py and from targetAtters dictionary read from
     grid_file
+    grids may be an iterable of (dict name, var, data), e.g. from
+    iter_grid_params, in place of soil_grid, snow_grid and veg_grid.  Each
+    variable is then written and released before the next is read.
+    Parameters are written as nc_type unless var is in var_types, chunked by
+    (ny, nx) chunks and compressed if zlib is True.
     """
     f = Dataset(myfile, 'w', format='NETCDF4')
 
@@ -913,109 +1129,92 @@ def write_netcdf(myfile, target_attrs, target_grid,
             except:
                 print('dont have units or description for {0}'.format(var))
 
-    # Layers
-    layers = f.createDimension('nlayer', soil_grid['soil_density'].shape[0])
-    layer_dims = ('nlayer', ) + dims2
-
-    # soil grid
-    for var, data in soil_grid.iteritems():
-        print('writing var: {0}'.format(var))
-
-        if data.ndim == 1:
-            v = f.createVariable(var, NC_DOUBLE, ('nlayer', ),
-                                 fill_value=FILLVALUE_F)
-            v[:] = data
-
-        elif data.ndim == 2:
-            v = f.createVariable(var, NC_DOUBLE, dims2, fill_value=FILLVALUE_F)
-            v[:, :] = data
-
-        elif data.ndim == 3:
-            v = f.createVariable(var, NC_DOUBLE, layer_dims,
-                                 fill_value=FILLVALUE_F)
-            v[:, :, :] = data
-        else:
-            raise IOError('all soil vars should be 2 or 3 dimensions')
-
-        # add attributes
-        v.units = unit.soil_param[var]
-        v.description = desc.soil_param[var]
-        v.long_name = var
-        if coordinates:
-            v.coordinates = coordinates
-
-    if snow_grid:
-        try:
-            del snow_grid['gridcell']
-        except:
-            pass
-
-        snowbnds = f.createDimension('snow_band',
-                                     snow_grid['AreaFract'].shape[0])
-        snow_dims = ('snow_band', ) + dims2
-
-        for var, data in snow_grid.iteritems():
+    if grids is None:
+        grids = ((name, var, data)
+                 for name, grid in [('soil_dict', soil_grid),
+                                    ('snow_dict', snow_grid),
+                                    ('veg_dict', veg_grid)] if grid
+                 for var, data in grid.iteritems())
+    if var_types is None:
+        var_types = {}
+
+    veg_written = False
+    for name, var, data in grids:
+        if name != 'soil_dict' and var == 'gridcell':
+            continue
+
+        if name == 'soil_dict':
             print('writing var: {0}'.format(var))
+            if data.ndim == 1:
+                dims = (get_dimension(f, 'nlayer', data.shape[0]), )
+            elif data.ndim == 2:
+                dims = dims2
+            elif data.ndim == 3:
+                dims = (get_dimension(f, 'nlayer', data.shape[0]), ) + dims2
+            else:
+                raise IOError('all soil vars should be 2 or 3 dimensions')
 
+        elif name == 'snow_dict':
+            print('writing var: {0}'.format(var))
             if data.ndim == 2:
-                v = f.createVariable(var, NC_DOUBLE, dims2,
-                                     fill_value=FILLVALUE_F)
-                v[:, :] = data
+                dims = dims2
             elif data.ndim == 3:
-                v = f.createVariable(var, NC_DOUBLE, snow_dims,
-                                     fill_value=FILLVALUE_F)
-                v[:, :, :] = data
+                dims = (get_dimension(f, 'snow_band', data.shape[0]), ) + \
+                    dims2
             else:
                 raise IOError('all snow vars should be 2 or 3 dimensions')
 
-            v.units = unit.snow_param[var]
-            v.description = desc.snow_param[var]
-            if coordinates:
-                v.coordinates = coordinates
-
-    if veg_grid:
-        try:
-            del veg_grid['gridcell']
-        except:
-            pass
-
-        veg_type = f.createDimension('veg_class', veg_grid['Cv'].shape[0])
-        root_zone = f.createDimension('root_zone', 3)
-        month = f.createDimension('month', 12)
-
-        v = f.createVariable('month', NC_INT, ('month', ))
-        v[:] = np.arange(1, 13)
-        v.long_name = 'month of year'
-
-        for var, data in veg_grid.iteritems():
+        else:
             print('writing var: {0} {1}'.format(var, data.shape))
+            if not veg_written:
+                get_dimension(f, 'month', 12)
+                v = f.createVariable('month', NC_INT, ('month', ))
+                v[:] = np.arange(1, 13)
+                v.long_name = 'month of year'
+                veg_written = True
 
-            if veg_grid[var].ndim == 2:
-                v = f.createVariable(var, NC_DOUBLE, dims2,
-                                     fill_value=FILLVALUE_F)
-                v[:, :] = data
-
-            elif veg_grid[var].ndim == 3:
-                mycoords = ('veg_class', ) + dims2
-                v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                     fill_value=FILLVALUE_F)
-                v[:, :, :] = data
-
+            if data.ndim == 2:
+                dims = dims2
+            elif data.ndim == 3:
+                dims = (get_dimension(f, 'veg_class', data.shape[0]), ) + \
+                    dims2
             elif var in ['LAI', 'albedo', 'veg_rough', 'displacement']:
-                mycoords = ('veg_class', 'month') + dims2
-                v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                     fill_value=FILLVALUE_F)
-                v[:, :, :, :] = data
-
-            elif veg_grid[var].ndim == 4:
-                mycoords = ('veg_class', 'root_zone', ) + dims2
-                v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                     fill_value=FILLVALUE_F)
-                v[:, :, :, :] = data
-
+                dims = (get_dimension(f, 'veg_class', data.shape[0]),
+                        'month') + dims2
+            elif data.ndim == 4:
+                dims = (get_dimension(f, 'veg_class', data.shape[0]),
+                        get_dimension(f, 'root_zone', data.shape[1])) + dims2
             else:
                 raise ValueError('only able to handle dimensions <=4')
 
+        if len(dims) > 1 and chunks:
+            chunksizes = (1, ) * (len(dims) - 2) + \
+                (min(chunks[0], len(f.dimensions[dims2[0]])),
+                 min(chunks[1], len(f.dimensions[dims2[1]])))
+        else:
+            chunksizes = None
+        var_type = var_types.get(var, nc_type)
+        v = f.createVariable(var, var_type, dims,
+                             fill_value=default_fillvals[var_type],
+                             zlib=zlib, complevel=complevel, shuffle=shuffle,
+                             chunksizes=chunksizes)
+        # write one (ny, nx) slab at a time
+        for index in np.ndindex(data.shape[:-2]):
+            chunk = data[index]
+            if not np.ma.isMaskedArray(chunk):
+                chunk = np.ma.masked_equal(chunk, FILLVALUE_F)
+            v[index] = chunk
+        del data
+
+        # add attributes
+        if name == 'soil_dict':
+            v.units = unit.soil_param[var]
+            v.description = desc.soil_param[var]
+            v.long_name = var
+        elif name == 'snow_dict':
+            v.units = unit.snow_param[var]
+            v.description = desc.snow_param[var]
+        else:
             v.long_name = var
             try:
                 v.units = unit.veg_param[var]
@@ -1024,30 +1223,33 @@ def write_netcdf(myfile, target_attrs, target_grid,
                 lib_var = 'lib_{0}'.format(var)
                 v.units = unit.veglib[lib_var]
                 v.description = desc.veglib[lib_var]
+        if coordinates:
+            v.coordinates = coordinates
 
-            if coordinates:
-                v.coordinates = coordinates
-
-        if veglib_dict and version != '5.0.dev':
+    if veg_written and veglib_dict and version != '5.0.dev':
+        for var, data in veglib_dict.iteritems():
             print('writing var: {0}'.format(var))
+            var_type = var_types.get(var, nc_type)
+            if data.ndim == 1:
+                v = f.createVariable(var, var_type,
+                                     (get_dimension(f, 'veg_class',
+                                                    data.shape[0]), ),
+                                     fill_value=default_fillvals[var_type])
+                v[:] = data
+            elif data.ndim == 2:
+                v = f.createVariable(var, var_type,
+                                     (get_dimension(f, 'veg_class',
+                                                    data.shape[0]),
+                                      'month', ),
+                                     fill_value=default_fillvals[var_type])
+                v[:, :] = data
+            else:
+                raise IOError('veglib_dict shouldnt have data with more \
+                               that 2 dimentions')
 
-            for var, data in veglib_dict.iteritems():
-                if data.ndim == 1:
-                    v = f.createVariable(var, NC_DOUBLE, ('veg_class', ),
-                                         fill_value=FILLVALUE_F)
-                    v[:] = data
-                elif data.ndim == 2:
-                    v = f.createVariable(var, NC_DOUBLE,
-                                         ('veg_class', 'month', ),
-                                         fill_value=FILLVALUE_F)
-                    v[:, :] = data
-                else:
-                    raise IOError('veglib_dict shouldnt have data with more \
-                                   that 2 dimentions')
-
-                v.units = unit.veglib[var]
-                v.description = desc.veglib[var]
-                v.long_name = var
+            v.units = unit.veglib[var]
+            v.description = desc.veglib[var]
+            v.long_name = var
 
     f.close()
 
@@ -1056,29 +1258,151 @@ def write_netcdf(myfile, target_attrs, target_grid,
 
 
 # -------------------------------------------------------------------- #
-def soil(in_file, nlayers=3):
+def get_dimension(f, name, size):
+    """create dimension name in f if it does not exist yet, returns name"""
+    if name not in f.dimensions:
+        f.createDimension(name, size)
+    elif len(f.dimensions[name]) != size:
+        raise ValueError('dimension {0} has length {1}, not '
+                         '{2}'.format(name, len(f.dimensions[name]), size))
+    return name
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def soil(in_file, nlayers=3, processes=1, cache_dir=None):
     """
     Load the entire soil file into a dictionary of numpy arrays.
     Also reorders data to match gridcell order of soil file.
     """
     print('reading {0}'.format(in_file))
-    data = np.loadtxt(in_file)
+    data = read_columns(in_file, processes=processes, cache_dir=cache_dir)
 
     c = cols(nlayers=nlayers)
 
+    # the column groups are contiguous so slicing returns views of data
     soil_dict = OrderedDict()
     for var, columns in c.soil_param.iteritems():
-        soil_dict[var] = np.squeeze(data[:, columns])
+        soil_dict[var] = np.squeeze(data[:, columns[0]:columns[-1] + 1])
+
+    # report duplicate gridcell numbers
+    align_records(soil_dict['gridcell'], soil_dict['gridcell'], 'soil')
 
     return soil_dict
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+def read_columns(in_file, processes=1, cache_dir=None,
+                 block_size=BLOCK_SIZE):
+    """
+    Read a whitespace delimited table of numbers into a 2d float64 array.
+    The file is parsed in blocks of whole lines straight into a preallocated
+    array, optionally in parallel over byte ranges.  If cache_dir is given,
+    the parsed array is cached there as a .npy file keyed on the absolute
+    path, size and modification time of in_file.
+    """
+    if cache_dir:
+        stat = os.stat(in_file)
+        path_hash = hashlib.md5(os.path.abspath(in_file)).hexdigest()[:16]
+        prefix = '{0}.{1}.'.format(os.path.basename(in_file), path_hash)
+        cache_file = os.path.join(cache_dir, '{0}{1}_{2}.npy'.format(
+            prefix, stat.st_size, int(stat.st_mtime * 1e6)))
+        if os.path.isfile(cache_file):
+            print('reading cached {0}'.format(cache_file))
+            return np.load(cache_file)
+
+    blocks = byte_ranges(in_file, block_size)
+    ncols = 0
+    nrows = 1
+    with open(in_file, 'rb') as f:
+        for line in iter(f.readline, b''):
+            nrows += 1
+            ncols = len(line.split(b'#')[0].split())
+            if ncols:
+                break
+        for chunk in iter(lambda: f.read(block_size), b''):
+            nrows += chunk.count(b'\n')
+
+    data = np.empty((nrows, ncols))
+    args = [(in_file, start, end, ncols) for start, end in blocks]
+    if processes > 1 and len(blocks) > 1:
+        pool = multiprocessing.Pool(processes=processes)
+        parsed = pool.imap(parse_block_star, args)
+    else:
+        pool = None
+        parsed = (parse_block(*a) for a in args)
+
+    row = 0
+    for block in parsed:
+        data[row:row + len(block)] = block
+        row += len(block)
+    if pool:
+        pool.close()
+        pool.join()
+    data = data[:row]
+
+    if cache_dir:
+        # remove the stale caches of this in_file only (file names may hold
+        # glob patterns, so match them by hand)
+        for old in os.listdir(cache_dir):
+            if (old.startswith(prefix) and
+                    re.match(r'\d+_\d+\.npy$', old[len(prefix):])):
+                os.remove(os.path.join(cache_dir, old))
+        np.save(cache_file, data)
+
+    return data
+
+
+def byte_ranges(in_file, block_size=BLOCK_SIZE):
+    """(start, end) byte offsets of in_file split at line boundaries"""
+    size = os.path.getsize(in_file)
+    ranges = []
+    start = 0
+    with open(in_file, 'rb') as f:
+        while start < size:
+            f.seek(min(start + block_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_block(in_file, start, end, ncols):
+    """parse the lines between byte offsets start and end of in_file"""
+    with open(in_file, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start)
+    values = None
+    if b'#' not in text:
+        values = np.fromstring(text, sep=' ')
+        # fromstring stops at the first token it can't parse, check that
+        # every line was read (blank lines are left to loadtxt)
+        nlines = text.count(b'\n') + (not text.endswith(b'\n'))
+        if values.size != nlines * ncols:
+            values = None
+    if values is None:
+        values = np.loadtxt(BytesIO(text), ndmin=2)
+    if values.size % ncols:
+        raise ValueError('{0}: expected {1} columns in every row between '
+                         'bytes {2} and {3}'.format(in_file, ncols, start,
+                                                    end))
+    return values.reshape(-1, ncols)
+
+
+def parse_block_star(args):
+    """Unpack the arguments of parse_block (for multiprocessing.Pool.imap)"""
+    return parse_block(*args)
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def snow(snow_file, soil_dict, snow_bands=5):
     """
     Load the entire snow file into a dictionary of numpy arrays.
-    Also reorders data to match gridcell order of soil file.
+    Also reorders data to match gridcell order of soil file, unless soil_dict
+    is None.
     """
 
     print('reading {0}'.format(snow_file))
@@ -1091,12 +1415,23 @@ def snow(snow_file, soil_dict, snow_bands=5):
     for var in c.snow_param:
         snow_dict[var] = data[:, c.snow_param[var]]
 
-    target = soil_dict['gridcell'].argsort()
-    indexes = target[np.searchsorted(soil_dict['gridcell'][target],
-                                     snow_dict['cellnum'])]
+    if soil_dict is not None:
+        snow_dict = reorder_snow(snow_dict, soil_dict)
+
+    return snow_dict
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def reorder_snow(snow_dict, soil_dict):
+    """reorder the snow records to match gridcell order of soil file"""
+    indexes, found = align_records(soil_dict['gridcell'],
+                                   snow_dict['cellnum'][:, 0], 'snow')
 
     for var in snow_dict:
-        snow_dict[var] = np.squeeze(snow_dict[var][indexes])
+        snow_dict[var] = snow_dict[var][indexes]
+        snow_dict[var][~found] = FILLVALUE_F
+        snow_dict[var] = np.squeeze(snow_dict[var])
 
     return snow_dict
 # -------------------------------------------------------------------- #
@@ -1106,89 +1441,198 @@ def snow(snow_file, soil_dict, snow_bands=5):
 def veg(veg_file, soil_dict, maxRoots=3, vegClasses=11,
         cells=False, BLOWING_SNOW=False, LAIindex=False):
     """
-    Read the vegetation file from vegFile.  Assumes max length for rootzones
-    and vegclasses.  Also reorders data to match gridcell order of soil file.
+    Read the vegetation file from vegFile in a single pass.  Assumes max
+    length for rootzones and vegclasses.  Only the first cells records are
+    read if cells is given.  Also reorders data to match gridcell order of
+    soil file, unless soil_dict is None.
     """
 
     print('reading {0}'.format(veg_file))
 
-    with open(veg_file) as f:
-        lines = f.readlines()
-
-    if not cells:
-        cells = len(lines)
+    with open(veg_file, 'rb') as f:
+        text = f.read()
+
+    # number of values on a tile line, from the first tile in the file
+    nveg = 0
+    for line in iter(BytesIO(text).readline, b''):
+        values = line.split()
+        if nveg and values:
+            tile_width = len(values)
+            break
+        elif values:
+            nveg = int(values[1])
+    else:
+        tile_width = 2 + 2 * maxRoots + 3 * BLOWING_SNOW
+    if BLOWING_SNOW:
+        rind = (tile_width - 5) // 2
+    else:
+        rind = (tile_width - 2) // 2
+    if rind > maxRoots:
+        raise ValueError('{0} has {1} root zones, more than maxRoots '
+                         '({2})'.format(veg_file, rind, maxRoots))
+    if LAIindex:
+        step = tile_width + 12
+    else:
+        step = tile_width
+
+    tokens = np.fromstring(text, sep=' ')
+    widths = line_widths(text)
+    del text
+
+    # walk the token stream: each gridcell, Nveg header is followed by Nveg
+    # tiles of step values
+    headers = []
+    pos = 0
+    ntokens = len(tokens)
+    end = ntokens
+    while pos < ntokens - 1:
+        if cells and len(headers) == cells:
+            end = pos
+            break
+        headers.append(pos)
+        pos += 2 + int(tokens.item(pos + 1)) * step
+    if pos != end:
+        raise ValueError('{0} does not match the expected layout of {1} '
+                         'values per vegetation tile'.format(veg_file, step))
+
+    headers = np.array(headers, dtype=int)
+    cells = len(headers)
+    gridcel = tokens[headers]
+    Nveg = tokens[headers + 1]
+    ntiles = Nveg.astype(int)
+
+    # every line must be a header, a tile line or an LAI line
+    if LAIindex:
+        tile_lines = [tile_width, 12]
+    else:
+        tile_lines = [tile_width]
+    nlines = cells + ntiles.sum() * len(tile_lines)
+    if end < ntokens:
+        widths = widths[:nlines]
+    if end != 2 * cells + ntiles.sum() * step or len(widths) != nlines:
+        raise ValueError('{0} does not match the expected layout of {1} '
+                         'values per vegetation tile'.format(veg_file, step))
+    header_lines = np.arange(cells) + \
+        (ntiles.cumsum() - ntiles) * len(tile_lines)
+    expected = np.empty(nlines, dtype=int)
+    expected[:] = -1
+    expected[header_lines] = 2
+    expected[expected < 0] = np.tile(tile_lines, ntiles.sum())
+    bad = np.flatnonzero(widths != expected)
+    if len(bad):
+        raise ValueError('{0}: line {1} has {2} values, expected '
+                         '{3}'.format(veg_file, bad[0] + 1, widths[bad[0]],
+                                      expected[bad[0]]))
+
+    # flat (tile, value) records, then scatter them to (cell, class)
+    cell = np.repeat(np.arange(cells), ntiles)
+    tile = np.arange(len(cell)) - np.repeat(ntiles.cumsum() - ntiles, ntiles)
+    first = headers[cell] + 2 + tile * step
+    tiles = tokens[first[:, np.newaxis] + np.arange(step)]
+    del tokens
+    vind = tiles[:, 0].astype(int) - 1
 
-    gridcel = np.zeros(cells)
-    Nveg = np.zeros(cells)
     Cv = np.zeros((cells, vegClasses))
+    Cv[cell, vind] = tiles[:, 1]
     root_depth = np.zeros((cells, vegClasses, maxRoots))
+    root_depth[cell, vind, :rind] = tiles[:, 2:2 + 2 * rind:2]
     root_fract = np.zeros((cells, vegClasses, maxRoots))
+    root_fract[cell, vind, :rind] = tiles[:, 3:3 + 2 * rind:2]
+
+    veg_dict = OrderedDict()
+    veg_dict['gridcell'] = gridcel
+    veg_dict['Nveg'] = Nveg
+    veg_dict['Cv'] = Cv
+    veg_dict['root_depth'] = root_depth
+    veg_dict['root_fract'] = root_fract
+
     if BLOWING_SNOW:
-        sigma_slope = np.zeros((cells, vegClasses))
-        lag_one = np.zeros((cells, vegClasses))
-        fetch = np.zeros((cells, vegClasses))
+        for i, var in enumerate(['sigma_slope', 'lag_one', 'fetch']):
+            veg_dict[var] = np.zeros((cells, vegClasses))
+            veg_dict[var][cell, vind] = tiles[:, tile_width - 3 + i]
+
     if LAIindex:
-        lfactor = 2
-        LAI = np.zeros((cells, vegClasses, 12))
-    else:
-        lfactor = 1
+        veg_dict['LAI'] = np.zeros((cells, vegClasses, 12))
+        veg_dict['LAI'][cell, vind, :] = tiles[:, tile_width:]
 
-    row = 0
-    cell = 0
+    if soil_dict is not None:
+        veg_dict = reorder_veg(veg_dict, soil_dict)
 
-    while row < len(lines):
-        line = lines[row].strip('\n').split(' ')
-        gridcel[cell], Nveg[cell] = np.array(line).astype(int)
-        numrows = Nveg[cell]*lfactor + row
-        row += 1
+    return veg_dict
+# -------------------------------------------------------------------- #
 
-        while row < numrows:
-            lines[row] = lines[row].strip()
-            line = lines[row].strip('\n').split(' ')
-            temp = np.array(line).astype(float)
-            vind = int(temp[0])-1
-            Cv[cell, vind] = temp[1]
 
-            if not BLOWING_SNOW:
-                rind = (len(temp)-2)/2
+# -------------------------------------------------------------------- #
+def reorder_veg(veg_dict, soil_dict):
+    """reorder the veg records to match gridcell order of soil file"""
+    indexes, found = align_records(soil_dict['gridcell'],
+                                   veg_dict['gridcell'], 'veg')
 
-            else:
-                rind = (len(temp)-5)/2
-                sigma_slope[cell, vind, :rind] = temp[-3]
-                lag_one[cell, vind, :rind] = temp[-2]
-                fetch[cell, vind, :rind] = temp[-1]
-
-            root_depth[cell, vind, :rind] = temp[2::2]
-            root_fract[cell, vind, :rind] = temp[3::2]
-            row += 1
-            if LAIindex:
-                lines[row] = lines[row].strip()
-                line = lines[row].strip('\n').split(' ')
-                LAI[cell, vind, :] = np.array(line).astype(float)
-                row += 1
-        cell += 1
-    veg_dict = OrderedDict()
-    veg_dict['gridcell'] = gridcel[:cell]
-    veg_dict['Nveg'] = Nveg[:cell]
-    veg_dict['Cv'] = Cv[:cell, :]
-    veg_dict['root_depth'] = root_depth[:cell, :]
-    veg_dict['root_fract'] = root_fract[:cell, :]
+    # gridcells without a veg record are left as bare soil
+    for var in veg_dict:
+        veg_dict[var] = veg_dict[var][indexes]
+        veg_dict[var][~found] = 0
+    soil_cells = np.atleast_1d(soil_dict['gridcell'])
+    veg_dict['gridcell'][~found] = soil_cells[~found]
+    for var in veg_dict:
+        veg_dict[var] = np.squeeze(veg_dict[var])
 
-    if BLOWING_SNOW:
-        veg_dict['sigma_slope'] = sigma_slope[:cell, :]
-        veg_dict['lag_one'] = lag_one[:cell, :]
-        veg_dict['fetch'] = fetch[:cell, :]
+    return veg_dict
 
-    if LAIindex:
-        veg_dict['LAI'] = LAI[:cell, :, :]
 
-    inds = []
-    for sn in soil_dict['gridcell']:
-        inds.append(np.nonzero(veg_dict['gridcell'] == sn))
+# -------------------------------------------------------------------- #
+def line_widths(text):
+    """number of whitespace separated values on each non-blank line of text"""
+    chars = np.frombuffer(text, dtype=np.uint8)
+    space = chars <= 32
+    starts = np.flatnonzero(space[:-1] & ~space[1:]) + 1
+    if len(chars) and not space[0]:
+        starts = np.append(0, starts)
+    del space
+    lines = np.searchsorted(np.flatnonzero(chars == 10), starts)
+    widths = np.bincount(lines)
+    return widths[widths > 0]
+# -------------------------------------------------------------------- #
 
-    for var in veg_dict:
-        veg_dict[var] = np.squeeze(veg_dict[var][inds])
-    return veg_dict
+
+# -------------------------------------------------------------------- #
+def align_records(target, cells, name='records'):
+    """
+    Find the indexes that reorder the records numbered by cells to match the
+    gridcell order of target (the soil file).  Returns the indexes and a
+    boolean array that is False where target has no record.  Missing,
+    duplicate (the first record is used) and unused records are reported.
+    """
+    target = np.asarray(target)
+    cells = np.asarray(cells)
+
+    order = np.argsort(cells, kind='mergesort')
+    sorted_cells = cells[order]
+    pos = np.searchsorted(sorted_cells, target)
+    found = pos < len(cells)
+    found[found] = sorted_cells[pos[found]] == target[found]
+    pos[~found] = 0
+    indexes = order[pos] if len(cells) else pos
+
+    missing = target[~found]
+    if len(missing):
+        print('WARNING: {0} gridcells have no {1} record, '
+              'e.g. {2}'.format(len(missing), name, missing[:5]))
+
+    duplicates = np.unique(sorted_cells[1:][sorted_cells[1:] ==
+                                            sorted_cells[:-1]])
+    if len(duplicates):
+        print('WARNING: {0} gridcells have more than one {1} record, using '
+              'the first, e.g. {2}'.format(len(duplicates), name,
+                                           duplicates[:5]))
+
+    unused = np.setdiff1d(cells, target)
+    if len(unused):
+        print('WARNING: {0} gridcells in the {1} records are not in the '
+              'soil file, e.g. {2}'.format(len(unused), name, unused[:5]))
+
+    return indexes, found
+# -------------------------------------------------------------------- #
 
 
 # -------------------------------------------------------------------- #
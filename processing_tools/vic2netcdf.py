@@ -17,6 +17,7 @@ from os import path
 from glob import glob
 from re import findall
 from collections import OrderedDict, deque
+from itertools import islice
 from bisect import bisect_left
 from argparse import ArgumentParser
 from getpass import getuser
@@ -29,9 +30,14 @@ import socket
 import subprocess
 import dateutil.relativedelta as relativedelta
 import os
+import shutil
 import sys
 import numpy as np
 import time as tm
+try:
+    import zarr
+except ImportError:
+    zarr = None
 
 SECSPERDAY = 86400.0
 
@@ -44,11 +50,21 @@ NC_DOUBLE = 'f8'
 NC_FLOAT = 'f4'
 NC_INT = 'i4'
 
+# Output layouts
+#   grid: (time, [level,] y, x)
+#   transposed: (y, x, [level,] time)
+#   station: (cell, [level,] time) over only the active (input) cells
+#   gathered: (time, [level,] landpoint), CF compression by gathering
+LAYOUTS = ['grid', 'transposed', 'station', 'gathered']
+
 # Default configuration
 default_config = {'OPTIONS': {'out_file_format': 'NETCDF3_64BIT',
                               'precision': 'single',
                               'calendar': 'standard',
                               'time_segment': 'month',
+                              'layout': 'grid',
+                              'block_size': 10000,
+                              'zarr_time_chunk': None,
                               'snow_bands': False,
                               'veg_tiles': False,
                               'soil_layers': False},
@@ -61,12 +77,13 @@ class Point(object):
     '''Creates a point class for intellegently
     storing coordinate information'''
 
-    def __init__(self, lat='', lon='', x='', y='', filename=''):
+    def __init__(self, lat='', lon='', x='', y='', cell='', filename=''):
         '''Defines x and y variables'''
         self.lat = lat
         self.lon = lon
         self.x = x
         self.y = y
+        self.cell = cell
         self.filename = filename
 
     def _open_binary(self):
@@ -88,6 +105,54 @@ class Point(object):
 
         return
 
+    def _open_ascii_stream(self):
+        print('opening ascii file: {0}'.format(self.filename))
+        self.f = open(self.filename, 'r')
+        self._ncols = len(self.f.readline().split())
+        self.f.seek(0)
+
+        # reusable buffers, (name, record)
+        self._block = np.empty((len(self.usecols), self.block_size))
+        self._block_len = 0
+        self._block_pos = 0
+        self._values = np.empty((len(self.usecols), 0))
+
+    def _read_block(self):
+        """ parse the next block_size records into the block buffer """
+        lines = list(islice(self.f, self.block_size))
+        data = np.fromstring(''.join(lines), sep=' ')
+        if data.size != len(lines) * self._ncols:
+            raise ValueError('Unable to parse {0} records from {1}, expected '
+                             '{2} columns'.format(len(lines), self.filename,
+                                                  self._ncols))
+        data = data.reshape(len(lines), self._ncols)
+
+        self._block[:, :len(lines)] = data[:, self.usecols].T
+        self._block_len = len(lines)
+        self._block_pos = 0
+
+    def _read_ascii_stream(self, count):
+        if count > self._values.shape[1]:
+            self._values = np.empty((len(self.usecols), count))
+
+        filled = 0
+        while filled < count:
+            if self._block_pos == self._block_len:
+                self._read_block()
+                if not self._block_len:
+                    raise ValueError('Reached end of file {0} before reading '
+                                     '{1} records'.format(self.filename,
+                                                          count))
+            n = min(count - filled, self._block_len - self._block_pos)
+            self._values[:, filled:filled+n] = \
+                self._block[:, self._block_pos:self._block_pos+n]
+            filled += n
+            self._block_pos += n
+
+        self.df = dict(zip(self.names, self._values[:, :count]))
+
+        return
+
     def _read_binary(self, count=-1):
 
         d = np.fromfile(self.f, dtype=self.dt, count=count)
@@ -107,6 +172,10 @@ class Point(object):
         print('reading netcdf file: {0}'.format(self.filename))
         return
 
+    def get_values(self, name):
+        '''return the values read for name as a numpy array'''
+        return np.asarray(self.df[name])
+
     def close(self):
         print('closing file: {0}'.format(self.filename))
         try:
@@ -150,6 +219,11 @@ class Plist(deque):
             self[i].y = yinds[i]
         return
 
+    def add_cells(self):
+        for i in xrange(len(self)):
+            self[i].cell = i
+        return
+
     def get_ys(self):
         return np.array([p.y for p in self])
 
@@ -157,10 +231,11 @@ class Plist(deque):
         return np.array([p.x for p in self])
 
     def get_data(self, name, data_slice):
-        return np.array([p.df[name].values[data_slice] for p in self])
+        return np.array([p.get_values(name)[data_slice] for p in self])
 
-    def set_fileformat(self, fileformat):
-        """sets and assigns fileformat specific attributes and methods"""
+    def set_fileformat(self, fileformat, stream=False):
+        """sets and assigns fileformat specific attributes and methods
+        if stream, ascii files are read in blocks of block_size records"""
 
         if fileformat == 'ascii':
             delimeter = r'\t'  # VIC ascii files are tab seperated
@@ -169,7 +244,10 @@ class Plist(deque):
 
         for p in self:
             p.fileformat = fileformat
-            if fileformat in ['ascii', 'csv']:
+            if fileformat == 'ascii' and stream:
+                p.open = p._open_ascii_stream
+                p.read = p._read_ascii_stream
+            elif fileformat in ['ascii', 'csv']:
                 p.open = p._open_ascii
                 p.delimeter = delimeter
                 p.read = p._read_ascii
@@ -205,21 +283,36 @@ class Plist(deque):
         for p in self:
             p.bin_mults = bin_mults
         return
+
+    def set_block_size(self, block_size):
+        for p in self:
+            p.block_size = block_size
+        return
 # -------------------------------------------------------------------- #
 
 
 class Segment(object):
     def __init__(self, num, i0, i1, nc_format, filename,
-                 memory_mode='original'):
+                 memory_mode='original', layout='grid', backend_kwargs=None):
         '''Class used for holding segment information '''
         self.num = num
         self.i0 = i0
         self.i1 = i1
         self.filename = filename
         self.fields = {}
+        self.levels = {}
+        self.packing = {}
+        self.pack_errors = {}
         self.memory_mode = memory_mode
 
-        self.nc_write(nc_format)
+        if layout not in LAYOUTS:
+            raise ValueError('Unknown value for OPTIONS[layout] '
+                             'field: {0}'.format(layout))
+        self.layout = layout
+
+        if backend_kwargs is None:
+            backend_kwargs = {}
+        self.nc_write(nc_format, **backend_kwargs)
 
         # Set slice
         if memory_mode == 'original':
@@ -247,6 +340,10 @@ class Segment(object):
                    version=None,
                    **kwargs):
 
+        if self.append:
+            # written when the store was created
+            return
+
         self.f.title = title
         self.f.history = history
         self.f.institution = institution
@@ -345,10 +442,74 @@ End Date: {5}
             d = self.f.createDimension('soil_layers', soil_layers)
         return
 
+    def nc_cells(self, points):
+        """ define the cell dimension and coordinates (station layout) """
+        cell = self.f.createDimension('cell', len(points))
+
+        v = self.f.createVariable('cell_lat', NC_DOUBLE, ('cell', ))
+        v[:] = points.get_lats()
+        v.long_name = 'latitude of grid cell center'
+        v.units = 'degrees_north'
+
+        v = self.f.createVariable('cell_lon', NC_DOUBLE, ('cell', ))
+        v[:] = points.get_lons()
+        v.long_name = 'longitude of grid cell center'
+        v.units = 'degrees_east'
+
+        v = self.f.createVariable('cell_y', NC_INT, ('cell', ))
+        v[:] = points.get_ys()
+        v.long_name = 'y index of grid cell in domain'
+
+        v = self.f.createVariable('cell_x', NC_INT, ('cell', ))
+        v[:] = points.get_xs()
+        v.long_name = 'x index of grid cell in domain'
+        return
+
+    def nc_landpoints(self, points, y_x_dims):
+        """ define the landpoint dimension (gathered layout) """
+        landpoint = self.f.createDimension('landpoint', len(points))
+
+        shape = tuple(len(self.f.dimensions[dim]) for dim in y_x_dims)
+        v = self.f.createVariable('landpoint', NC_INT, ('landpoint', ))
+        v[:] = np.ravel_multi_index((points.get_ys(), points.get_xs()), shape)
+        v.long_name = 'active grid cell index'
+        v.compress = ' '.join(y_x_dims)
+        return
+
+    def field_dims(self, y_x_dims, dim4=None):
+        """ return the dimensions of a field for this segment's layout """
+        if dim4:
+            level = (dim4, )
+        else:
+            level = ()
+
+        if self.layout == 'grid':
+            return ('time', ) + level + tuple(y_x_dims)
+        elif self.layout == 'transposed':
+            return tuple(y_x_dims) + level + ('time', )
+        elif self.layout == 'station':
+            return ('cell', ) + level + ('time', )
+        elif self.layout == 'gathered':
+            return ('time', ) + level + ('landpoint', )
+
+    def field_index(self, point, level=None):
+        """ return the index of a point's timeseries in a field """
+        if level is None:
+            level = ()
+        else:
+            level = (level, )
+
+        if self.layout == 'grid':
+            return (slice(None), ) + level + (point.y, point.x)
+        elif self.layout == 'transposed':
+            return (point.y, point.x) + level + (slice(None), )
+        elif self.layout == 'station':
+            return (point.cell, ) + level + (slice(None), )
+        elif self.layout == 'gathered':
+            return (slice(None), ) + level + (point.cell, )
+
     def nc_fields(self, fields, y_x_dims, precision):
         """ define each field """
-        coords = ('time',)+tuple(y_x_dims)
-
         if precision == 'single':
             prec_global = NC_FLOAT
         elif precision == 'double':
@@ -370,9 +531,9 @@ End Date: {5}
                 if 'dim4' in field.keys():
                     if len(field['column']) == len(self.f.dimensions[field['dim4']]):
                         # 4d var
-                        coords = ('time',) + tuple([field['dim4']]) \
-                            + tuple(y_x_dims)
+                        coords = self.field_dims(y_x_dims, field['dim4'])
                         self.four_dim_vars.append(name)
+                        self.levels[name] = len(field['column'])
                     elif len(field['column']) != len(self.f.dimensions[field['dim4']]):
                         raise ValueError('Number of columns for variable {0} \
                                          does not match the length ({1}) of the \
@@ -381,7 +542,7 @@ End Date: {5}
                                                                field['dim4']))
                 else:
                     # standard 3d var
-                    coords = ('time',)+tuple(y_x_dims)
+                    coords = self.field_dims(y_x_dims)
                     self.three_dim_vars.append(name)
 
                 if 'type' in field.keys():
@@ -394,64 +555,310 @@ End Date: {5}
                                                           fill_value=fill_val,
                                                           zlib=False)
 
+                packing = pack_params(field, prec)
+                if packing:
+                    # data is quantized by self.pack, not by netCDF4
+                    self.fields[name].set_auto_scale(False)
+                    self.packing[name] = packing + (fill_val, prec)
+                    self.pack_errors[name] = 0.0
+
                 if 'units' in field.keys():
                     self.fields[name].long_name = name
-                    self.fields[name].coordinates = 'lon lat'
+                    if self.layout == 'station':
+                        self.fields[name].coordinates = 'cell_lon cell_lat'
+                    else:
+                        self.fields[name].coordinates = 'lon lat'
                     for key, val in field.iteritems():
                         setattr(self.fields[name], key, val)
+                    if packing:
+                        self.fields[name].scale_factor = packing[0]
+                        self.fields[name].add_offset = packing[1]
                 else:
                     raise ValueError('Field {0} missing units \
                                      attribute'.format(name))
         return
 
+    def pack(self, name, values):
+        """
+        Quantize values to the packed integer type of field name (if packed)
+        and keep track of the maximum round-trip error.
+        """
+        if name not in self.packing:
+            return values
+
+        scale_factor, add_offset, fill_val, prec = self.packing[name]
+
+        values = np.asarray(values, dtype=np.float64)
+        valid = np.isfinite(values)
+
+        packed = np.round((values - add_offset) / scale_factor)
+        np.clip(packed, *packed_range(prec), out=packed)
+        packed[~valid] = fill_val
+        packed = packed.astype(prec)
+
+        if valid.any():
+            error = np.abs(packed[valid] * scale_factor + add_offset
+                           - values[valid]).max()
+            self.pack_errors[name] = max(self.pack_errors[name], error)
+
+        return packed
+
     def allocate(self):
         self.data = {}
-        for name, field in self.fields.iteritems():
+        for name in self.three_dim_vars + self.four_dim_vars:
+            field = self.fields[name]
             if hasattr(field, '_FillValue'):
-                self.data[name] = np.zeros_like(field) + field._FillValue
+                self.data[name] = np.zeros(field.shape, dtype=field.dtype) \
+                    + field._FillValue
             else:
-                self.data[name] = np.zeros_like(field)
+                self.data[name] = np.zeros(field.shape, dtype=field.dtype)
 
     def nc_add_data_to_array(self, point):
         for name in self.three_dim_vars:
-            self.data[name][:, point.y, point.x] = point.df[name].values[self.slice]
+            self.data[name][self.field_index(point)] = \
+                self.pack(name, point.get_values(name)[self.slice])
         for name in self.four_dim_vars:
-            varshape = self.f.variables[name].shape[1]
-            for i in xrange(varshape):
+            for i in xrange(self.levels[name]):
                 subname = name + str(i)
-                self.data[name][:, i, point.y, point.x] = point.df[subname].values[self.slice]
+                self.data[name][self.field_index(point, i)] = \
+                    self.pack(name, point.get_values(subname)[self.slice])
 
     def nc_add_data_standard(self, points):
-        ys = points.get_ys()
-        xs = points.get_xs()
         for point in points:
             for name in self.three_dim_vars:
-                data = points.get_data(name, self.slice)
-                self.f.variables[name][:, ys, xs] = data
+                self.f.variables[name][self.field_index(point)] = \
+                    self.pack(name, point.get_values(name)[self.slice])
             for name in self.four_dim_vars:
-                varshape = self.f.variables[name].shape[1]
-                for i in xrange(varshape):
+                for i in xrange(self.levels[name]):
                     subname = name + str(i)
-                    self.f.variables[name][:, i, ys, xs] = point.df[subname].values[self.slice]
+                    self.f.variables[name][self.field_index(point, i)] = \
+                        self.pack(name, point.get_values(subname)[self.slice])
 
     def nc_write_data_from_array(self):
         """ write completed data arrays to disk """
-        for name in self.three_dim_vars:
-            self.f.variables[name][:, :, :] = self.data[name]
-        for name in self.four_dim_vars:
-                self.f.variables[name][:, :, :, :] = self.data[name]
-
-    def nc_write(self, nc_format):
-        self.f = Dataset(self.filename, mode="w", clobber=True,
-                         format=nc_format)
+        for name in self.three_dim_vars + self.four_dim_vars:
+            self.f.variables[name][:] = self.data[name]
+
+    def nc_write(self, nc_format, **kwargs):
+        if nc_format in OUTPUT_BACKENDS:
+            self.f = OUTPUT_BACKENDS[nc_format](self.filename,
+                                                time_offset=self.i0, **kwargs)
+            # an existing store already holds all metadata
+            self.append = self.f.append
+        else:
+            self.f = Dataset(self.filename, mode="w", clobber=True,
+                             format=nc_format)
+            self.append = False
         self.f.set_fill_on()
 
     def nc_close(self):
+        for name, error in sorted(self.pack_errors.iteritems()):
+            print('Packed {0} as {1}: maximum round-trip error '
+                  '{2}'.format(name, self.packing[name][3], error))
         self.f.close()
         print('Closed: {0}'.format(self.filename))
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+class ZarrDimension(object):
+    """ Dimension of a ZarrDataset """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __len__(self):
+        return self.size
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class ZarrVariable(object):
+    """
+    netCDF4.Variable work-alike for an array in a ZarrDataset.  Indexes along
+    the time dimension are relative to the segment and are offset into the
+    full time axis of the store.  When appending, attributes and arrays
+    without a time dimension are not written again.
+    """
+    def __init__(self, array, dimensions, fill_value=None, time_offset=0,
+                 time_count=None, append=False):
+        self.__dict__['_array'] = array
+        self.__dict__['_append'] = append
+        self.__dict__['dimensions'] = tuple(dimensions)
+        self.__dict__['_fill_value'] = fill_value
+        self.__dict__['_time_offset'] = time_offset
+        shape = list(array.shape)
+        if 'time' in dimensions:
+            self.__dict__['_time_axis'] = list(dimensions).index('time')
+            shape[self._time_axis] = time_count
+        else:
+            self.__dict__['_time_axis'] = None
+        self.__dict__['shape'] = tuple(shape)
+        self.__dict__['dtype'] = array.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getattr__(self, name):
+        if name == '_FillValue' and self._fill_value is not None:
+            return self._fill_value
+        try:
+            return self._array.attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if not self._append:
+            self._array.attrs[name] = json_attr(value)
+
+    def _index(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = list(key) + [slice(None)] * (len(self.shape) - len(key))
+        if self._time_axis is not None:
+            k = key[self._time_axis]
+            if isinstance(k, slice):
+                start, stop, step = k.indices(self.shape[self._time_axis])
+                key[self._time_axis] = slice(start + self._time_offset,
+                                             stop + self._time_offset, step)
+            else:
+                key[self._time_axis] = k + self._time_offset
+        return tuple(key)
+
+    def __getitem__(self, key):
+        return self._array.oindex[self._index(key)]
+
+    def __setitem__(self, key, value):
+        if self._append and self._time_axis is None:
+            return
+        self._array.oindex[self._index(key)] = value
+
+    def set_auto_scale(self, value):
+        """ data is never scaled by the zarr backend """
+        return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class ZarrDataset(object):
+    """
+    netCDF4.Dataset work-alike writing to a zarr directory store.
+
+    All segments write to a single store whose time dimension is the full
+    (time_size) time axis. Arrays are chunked along time by time_chunk.
+
+    With create, the store is built under a temporary name and moved into
+    place on close, so every array and all metadata exist before any segment
+    writes.  Otherwise the existing store is opened to append: the arrays
+    must match the expected shapes and chunks, and only the time region of
+    the segment is written, so segments that start and end on chunk
+    boundaries can be written concurrently by separate processes without
+    locking.  Dimension names are stored in the _ARRAY_DIMENSIONS attribute
+    of each array.
+    """
+    def __init__(self, filename, time_offset=0, time_size=None,
+                 time_chunk=None, create=False):
+        if zarr is None:
+            raise ImportError('The zarr package is required to write '
+                              'out_file_format: ZARR')
+        self.__dict__['filename'] = filename
+        self.__dict__['append'] = not create
+        if create:
+            self.__dict__['_path'] = '{0}.{1}.tmp'.format(filename,
+                                                          os.getpid())
+            self.__dict__['_group'] = zarr.open_group(self._path, mode='w')
+        else:
+            self.__dict__['_path'] = filename
+            self.__dict__['_group'] = zarr.open_group(filename, mode='r+')
+        self.__dict__['_time_offset'] = time_offset
+        self.__dict__['_time_size'] = time_size
+        self.__dict__['_time_chunk'] = time_chunk
+        self.__dict__['dimensions'] = OrderedDict()
+        self.__dict__['variables'] = OrderedDict()
+
+    def __getattr__(self, name):
+        try:
+            return self._group.attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if not self.append:
+            self._group.attrs[name] = json_attr(value)
+
+    def createDimension(self, name, size):
+        self.dimensions[name] = ZarrDimension(name, size)
+        return self.dimensions[name]
+
+    def createVariable(self, name, datatype, dimensions, fill_value=None,
+                       zlib=False):
+        shape = []
+        chunks = []
+        for dim in dimensions:
+            if dim == 'time':
+                shape.append(self._time_size)
+                chunks.append(self._time_chunk or self._time_size)
+            else:
+                shape.append(len(self.dimensions[dim]))
+                chunks.append(len(self.dimensions[dim]))
+
+        if fill_value is None:
+            store_fill = default_fillvals.get(np.dtype(datatype).str[1:])
+        else:
+            store_fill = fill_value
+
+        if self.append:
+            if name not in self._group:
+                raise ValueError('{0} is not in the zarr store {1}, remove '
+                                 'the store to create it '
+                                 'again'.format(name, self.filename))
+            array = self._group[name]
+            if array.shape != tuple(shape) or array.chunks != tuple(chunks):
+                raise ValueError('{0} in the zarr store {1} has shape {2} '
+                                 'and chunks {3}, expected {4} and {5} (see '
+                                 'OPTIONS[zarr_time_chunk])'.format(
+                                     name, self.filename, array.shape,
+                                     array.chunks, tuple(shape),
+                                     tuple(chunks)))
+        else:
+            array = self._group.create_dataset(name, shape=tuple(shape),
+                                               chunks=tuple(chunks),
+                                               dtype=datatype,
+                                               fill_value=store_fill)
+            array.attrs['_ARRAY_DIMENSIONS'] = list(dimensions)
+
+        time_count = None
+        if 'time' in self.dimensions:
+            time_count = len(self.dimensions['time'])
+        self.variables[name] = ZarrVariable(array, dimensions,
+                                            fill_value=fill_value,
+                                            time_offset=self._time_offset,
+                                            time_count=time_count,
+                                            append=self.append)
+        return self.variables[name]
+
+    def set_fill_on(self):
+        """ zarr arrays are always filled """
+        return
+
+    def close(self):
+        """
+        zarr directory stores are written chunk by chunk, a new store is
+        moved into place (unless another process created it first)
+        """
+        if self.append:
+            return
+        try:
+            os.rename(self._path, self.filename)
+        except OSError:
+            if not os.path.isdir(self.filename):
+                raise
+            shutil.rmtree(self._path)
+
+OUTPUT_BACKENDS = {'ZARR': ZarrDataset}
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 class NcVar(np.ndarray):
     """ Subclass of numpy array to cary netcdf attributes"""
@@ -534,6 +941,11 @@ def vic2nc(options, global_atts, domain_dict, fields):
     else:
         memory_mode = options['memory_mode']
 
+    if options['out_file_format'] == 'ZARR' and memory_mode == 'standard':
+        # per point writes would rewrite a whole chunk for every point
+        raise ValueError('out_file_format: ZARR requires memory_mode '
+                         'original or big_memory')
+
     print("\n-------------------------------")
     print("Configuration File Options")
     print("-------------OPTIONS-------------")
@@ -549,8 +961,11 @@ def vic2nc(options, global_atts, domain_dict, fields):
         print("{0}: {1}".format(*pair))
     print("--------RUN MODE--------")
     print('Memory Mode: {0}'.format(memory_mode))
+    print('Output Layout: {0}'.format(options['layout']))
     if memory_mode == 'standard':
         print('Chunksize={0}'.format(options['chunksize']))
+    elif memory_mode == 'original':
+        print('Block size={0}'.format(options['block_size']))
     print("---------------------------------\n")
     # ---------------------------------------------------------------- #
 
@@ -582,6 +997,7 @@ def vic2nc(options, global_atts, domain_dict, fields):
     # ---------------------------------------------------------------- #
     # Get grid index locations
     points = get_grid_inds(domain, points)
+    points.add_cells()
     # ---------------------------------------------------------------- #
 
     # ---------------------------------------------------------------- #
@@ -686,6 +1102,33 @@ def vic2nc(options, global_atts, domain_dict, fields):
     # Setup Segments
     segments = deque()
 
+    if options['out_file_format'] == 'ZARR':
+        # all segments are written to a single store
+        if options['zarr_time_chunk']:
+            time_chunk = options['zarr_time_chunk']
+        else:
+            time_chunk = time_chunksize([bisect_left(vic_datelist, t)
+                                         for t in segment_dates])
+        print('Zarr time chunk size: {0}'.format(time_chunk))
+        backend_kwargs = {'time_size': len(vic_ordtime),
+                          'time_chunk': time_chunk}
+
+        filename = path.join(options['out_directory'],
+                             "{0}.zarr".format(options['out_file_prefix']))
+        if not path.exists(filename):
+            # create every array and its metadata (and the whole time axis)
+            # before the segments write to the store
+            store = Segment(0, 0, len(vic_ordtime), 'ZARR', filename,
+                            memory_mode=memory_mode,
+                            layout=options['layout'],
+                            backend_kwargs=dict(backend_kwargs, create=True))
+            setup_segment(store, vic_datelist[0], vic_datelist[-1],
+                          vic_ordtime, options, global_atts, domain,
+                          domain_dict, points, fields)
+            store.nc_close()
+    else:
+        backend_kwargs = None
+
     for num in xrange(num_segments):
         # Segment time bounds
         t0 = segment_dates[num]
@@ -710,20 +1153,18 @@ def vic2nc(options, global_atts, domain_dict, fields):
                                                t0.strftime('%Y%m%d'),
                                                t1.strftime('%Y%m%d'))
 
+        if options['out_file_format'] == 'ZARR':
+            filename = "{0}.zarr".format(options['out_file_prefix'])
+
         filename = path.join(options['out_directory'], filename)
 
         # Setup segment and initialize netcdf
         segment = Segment(num, i0, i1, options['out_file_format'],
-                          filename, memory_mode=memory_mode)
-        segment.nc_globals(**global_atts)
-        segment.nc_time(t0, t1, vic_ordtime, options['calendar'])
-        segment.nc_dimensions(snow_bands=options['snow_bands'],
-                              veg_tiles=options['veg_tiles'],
-                              soil_layers=options['soil_layers'])
-
-        segment.nc_domain(domain)
-        segment.nc_fields(fields,
-                          domain_dict['y_x_dims'], options['precision'])
+                          filename, memory_mode=memory_mode,
+                          layout=options['layout'],
+                          backend_kwargs=backend_kwargs)
+        setup_segment(segment, t0, t1, vic_ordtime, options, global_atts,
+                      domain, domain_dict, points, fields)
 
         print(repr(segment))
         segments.append(segment)
@@ -749,13 +1190,12 @@ def vic2nc(options, global_atts, domain_dict, fields):
             for i, col in enumerate(field['column']):
                 names.append(name+str(i))
                 usecols.append(col)
-            if 'type' in field:
-                if type(field['type']) == list:
-                    dtypes.extend(field['type'])
-                else:
-                    dtypes.extend([field['type']] * len(field['column']))
+            if 'type' in field and type(field['type']) == list:
+                dtypes.extend(field['type'])
+            elif 'type' in field and not pack_params(field, field['type']):
+                dtypes.extend([field['type']] * len(field['column']))
             else:
-                dtypes.append([prec] * len(field['column']))
+                dtypes.extend([prec] * len(field['column']))
 
             if options['input_file_format'].lower() == 'binary':
                 if 'bin_dtype' in field:
@@ -778,7 +1218,7 @@ def vic2nc(options, global_atts, domain_dict, fields):
             names.append(name)
             usecols.append(field['column'])
 
-            if 'type' in field:
+            if 'type' in field and not pack_params(field, field['type']):
                 dtypes.append(field['type'])
             else:
                 dtypes.append(prec)
@@ -802,7 +1242,9 @@ def vic2nc(options, global_atts, domain_dict, fields):
     if options['input_file_format'].lower() == 'binary':
         points.set_bin_dtypes(bin_dtypes)
         points.set_bin_mults(bin_mults)
-    points.set_fileformat(options['input_file_format'])
+    points.set_block_size(int(options['block_size']))
+    points.set_fileformat(options['input_file_format'],
+                          stream=(memory_mode == 'original'))
     print('done')
     # ---------------------------------------------------------------- #
 
@@ -857,6 +1299,11 @@ def vic2nc(options, global_atts, domain_dict, fields):
         for point in points:
             point.open()
 
+        # Skip the records before the first segment
+        if segments[0].i0:
+            for point in points:
+                point.read(segments[0].i0)
+
         while segments:
             segment = segments.popleft()
             segment.allocate()
@@ -877,6 +1324,25 @@ def vic2nc(options, global_atts, domain_dict, fields):
 # -------------------------------------------------------------------- #
 
 
+def setup_segment(segment, t0, t1, times, options, global_atts, domain,
+                  domain_dict, points, fields):
+    """ define the attributes, dimensions and variables of a segment """
+    segment.nc_globals(**global_atts)
+    segment.nc_time(t0, t1, times, options['calendar'])
+    segment.nc_dimensions(snow_bands=options['snow_bands'],
+                          veg_tiles=options['veg_tiles'],
+                          soil_layers=options['soil_layers'])
+
+    segment.nc_domain(domain)
+    if options['layout'] == 'station':
+        segment.nc_cells(points)
+    elif options['layout'] == 'gathered':
+        segment.nc_landpoints(points, domain_dict['y_x_dims'])
+    segment.nc_fields(fields, domain_dict['y_x_dims'], options['precision'])
+    return
+# -------------------------------------------------------------------- #
+
+
 def read_config(config_file):
     """
     Return a dictionary with subdictionaries of all configFile options/values
@@ -937,6 +1403,69 @@ def config_type(value):
 # -------------------------------------------------------------------- #
 
 
+def json_attr(value):
+    """ convert an attribute value to a json serializable type """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (list, tuple)):
+        return [json_attr(v) for v in value]
+    return value
+# -------------------------------------------------------------------- #
+
+
+def time_chunksize(bounds):
+    """
+    Return the largest chunk size along time for which every segment bound
+    (i0, i1) falls on a chunk boundary.
+    """
+    size = 0
+    for bound in bounds:
+        while bound:
+            size, bound = bound, size % bound
+    return max(size, 1)
+# -------------------------------------------------------------------- #
+
+
+def pack_params(field, prec):
+    """
+    Return the (scale_factor, add_offset) used to pack a field into the
+    integer type prec, or None if the field is not packed.
+    The packing parameters are taken from the field's scale_factor and
+    add_offset attributes or are computed from its pack_range (min, max).
+    """
+    if np.dtype(prec).kind not in 'iu':
+        return None
+
+    if 'scale_factor' in field:
+        return (float(field['scale_factor']),
+                float(field.get('add_offset', 0.0)))
+    elif 'pack_range' in field:
+        vmin, vmax = map(float, field['pack_range'])
+        imin, imax = packed_range(prec)
+        scale_factor = (vmax - vmin) / float(imax - imin)
+        add_offset = vmin - imin * scale_factor
+        return (scale_factor, add_offset)
+
+    return None
+# -------------------------------------------------------------------- #
+
+
+def packed_range(prec):
+    """
+    Return the range of valid packed values for integer type prec, excluding
+    the values at or beyond the default _FillValue.
+    """
+    info = np.iinfo(prec)
+    fill_val = default_fillvals[prec]
+    if fill_val == info.max:
+        return info.min, info.max - 1
+    else:
+        return max(info.min, fill_val + 1), info.max
+# -------------------------------------------------------------------- #
+
+
 def get_file_coords(files):
     """
     Get list of Point objects
@@ -1027,6 +1556,35 @@ def read_domain(domain_dict):
 # -------------------------------------------------------------------- #
 
 
+def expand_gathered(data, landpoint, shape):
+    """
+    Expand data compressed by gathering (last axis is the gathered dimension)
+    back to the full grid of the given shape.  Returns a masked array.
+    """
+    data = np.asanyarray(data)
+    full = np.ma.masked_all(data.shape[:-1] + (int(np.prod(shape)), ),
+                            dtype=data.dtype)
+    full[..., np.asarray(landpoint)] = data
+
+    return full.reshape(data.shape[:-1] + tuple(shape))
+# -------------------------------------------------------------------- #
+
+
+def read_gathered(nc_file, varname):
+    """
+    Read a variable written with the gathered layout and return it on the
+    full (time, [level,] y, x) grid.
+    """
+    f = Dataset(nc_file)
+    landpoint = f.variables['landpoint']
+    shape = [len(f.dimensions[dim]) for dim in landpoint.compress.split()]
+    data = expand_gathered(f.variables[varname][:], landpoint[:], shape)
+    f.close()
+
+    return data
+# -------------------------------------------------------------------- #
+
+
 def get_grid_inds(domain, points):
     """
     Find location of lat/lon points in 2d target grid.
@@ -0,0 +1,135 @@
+#!/usr/local/env python
+"""
+test_fix_global_forcings.py
+
+Set to run with pytest
+
+Usage: py.test (from VICpy or test directory)
+"""
+import os
+import sys
+import numpy as np
+from netCDF4 import Dataset
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'forcing_tools'))
+
+# -------------------------------------------------------------------- #
+# Unit tests for fix_global_forcings.py
+
+
+def make_forcings(in_file, ntime=5):
+    """ALMA style input with 2d nav_lat/nav_lon and masked ocean cells"""
+    lats = np.arange(40.25, 45, 0.5)
+    lons = np.arange(-119.75, -112, 0.5)
+    lon, lat = np.meshgrid(lons, lats)
+    f = Dataset(in_file, 'w')
+    f.createDimension('tstep', None)
+    f.createDimension('y', len(lats))
+    f.createDimension('x', len(lons))
+    f.createVariable('nav_lat', 'f4', ('y', 'x'))[:] = lat
+    f.createVariable('nav_lon', 'f4', ('y', 'x'))[:] = lon
+    time = f.createVariable('time', 'f4', ('tstep', ))
+    time[:] = np.arange(ntime) * 86400
+    time.units = 'seconds since 1950-01-01 00:00:00'
+    time.long_name = 'Time axis'
+    rs = np.random.RandomState(0)
+    for name in ['Prec', 'Tmax', 'Tmin', 'Wind']:
+        v = f.createVariable(name, 'f4', ('tstep', 'y', 'x'), fill_value=1e20)
+        v.units = 'units'
+        v.long_name = name
+        data = np.ma.masked_array(rs.rand(ntime, len(lats), len(lons)))
+        data[:, :, :3] = np.ma.masked
+        v[:] = data
+    f.close()
+
+
+def make_domain():
+    """0.3 degree target cells with corners"""
+    lat, lon = np.meshgrid(np.arange(41, 44, 0.3),
+                           np.arange(-118, -113, 0.3) + 360, indexing='ij')
+    return {'lat': lat, 'lon': lon, 'mask': None,
+            'lat_bounds': np.dstack([lat - .15, lat - .15, lat + .15,
+                                     lat + .15]),
+            'lon_bounds': np.dstack([lon - .15, lon + .15, lon + .15,
+                                     lon - .15])}
+
+
+def setup_process_file(tmpdir, monkeypatch):
+    """Point fix_global_forcings at a synthetic input file in tmpdir"""
+    import fix_global_forcings as fgf
+    import regrid
+    in_dir = tmpdir.mkdir('in')
+    out_dir = tmpdir.mkdir('out')
+    weight_dir = tmpdir.mkdir('weights')
+    make_forcings(str(in_dir.join('raw.nc')))
+    monkeypatch.chdir(str(in_dir))
+    monkeypatch.setattr(fgf, 'outpath', str(out_dir) + os.sep)
+    monkeypatch.setattr(fgf, 'weightpath', str(weight_dir))
+    monkeypatch.setattr(fgf, 'timechunk', 2)
+    regrid._WEIGHTS.clear()
+    return fgf, out_dir, weight_dir
+
+
+def test_process_file(tmpdir, monkeypatch):
+    import regrid
+    from scipy import sparse
+    fgf, out_dir, weight_dir = setup_process_file(tmpdir, monkeypatch)
+    domain = make_domain()
+
+    outfiles = fgf.process_file('raw.nc', domain)
+    assert sorted(os.listdir(str(out_dir))) == ['raw_RASM_BIL.nc',
+                                                 'raw_RASM_CON.nc']
+    weight_files = sorted(os.listdir(str(weight_dir)))
+    assert len(weight_files) == 2
+    assert not [w for w in weight_files if not w.endswith('.npz')]
+
+    lat, lon = fgf.fixed_coords('raw.nc')
+    f = Dataset('raw.nc')
+    for (method, suffix), outfile in zip(fgf.methods, outfiles):
+        assert outfile.endswith(suffix)
+        name = [w for w in weight_files if method in w][0]
+        weights = sparse.load_npz(str(weight_dir.join(name)))
+        out = Dataset(outfile)
+        assert out.remap_method == method
+        for invar, var in fgf.forcing_vars:
+            expected = regrid.remap(weights, f.variables[invar][:],
+                                    domain['lat'].shape)
+            result = out.variables[var][:]
+            np.testing.assert_array_equal(np.ma.getmaskarray(result),
+                                          np.ma.getmaskarray(expected))
+            np.testing.assert_allclose(result.filled(0), expected.filled(0),
+                                       rtol=1e-6)
+        np.testing.assert_array_equal(out.variables['time'][:],
+                                      np.arange(5) * 86400)
+        out.close()
+    f.close()
+
+
+def test_process_file_format(tmpdir, monkeypatch):
+    fgf, out_dir, weight_dir = setup_process_file(tmpdir, monkeypatch)
+    domain = make_domain()
+    for outfile in fgf.process_file('raw.nc', domain):
+        out = Dataset(outfile)
+        assert out.data_model == 'NETCDF4'
+        for invar, var in fgf.forcing_vars:
+            outvar = out.variables[var]
+            assert outvar.dtype == np.float32
+            assert outvar._FillValue == np.float32(1e20)
+            filters = outvar.filters()
+            assert filters['zlib']
+            assert filters['shuffle']
+            assert filters['complevel'] == fgf.complevel
+            assert outvar.chunking() == [2] + list(domain['lat'].shape)
+        out.close()
+
+    # the output dtype can be set instead of following the source
+    monkeypatch.setattr(fgf, 'dtype', 'f8')
+    monkeypatch.setattr(fgf, 'complevel', 1)
+    for outfile in fgf.process_file('raw.nc', domain):
+        out = Dataset(outfile)
+        for invar, var in fgf.forcing_vars:
+            outvar = out.variables[var]
+            assert outvar.dtype == np.float64
+            assert outvar.filters()['complevel'] == 1
+        out.close()
+
+# -------------------------------------------------------------------- #
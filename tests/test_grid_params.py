@@ -0,0 +1,335 @@
+#!/usr/local/env python
+"""
+test_grid_params.py
+
+Set to run with pytest
+
+Usage: py.test (from VICpy or test directory)
+"""
+import os
+import sys
+import pytest
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'param_tools'))
+
+# -------------------------------------------------------------------- #
+# Unit tests for grid_params.py
+
+
+def test_read_columns(tmpdir):
+    from grid_params import read_columns
+    data = np.random.RandomState(0).rand(50, 7) * 100
+    in_file = str(tmpdir.join('soil.txt'))
+    np.savetxt(in_file, data, fmt='%1.6f')
+    expected = np.loadtxt(in_file)
+
+    np.testing.assert_array_equal(read_columns(in_file), expected)
+    for processes in [1, 2]:
+        np.testing.assert_array_equal(
+            read_columns(in_file, processes=processes, block_size=100),
+            expected)
+
+    cache_dir = tmpdir.mkdir('cache')
+    read_columns(in_file, cache_dir=str(cache_dir))
+    cached = cache_dir.listdir()
+    assert len(cached) == 1
+    np.testing.assert_array_equal(np.load(str(cached[0])), expected)
+    np.testing.assert_array_equal(read_columns(in_file,
+                                               cache_dir=str(cache_dir)),
+                                  expected)
+
+    # a changed file replaces the stale cache
+    np.savetxt(in_file, data[:10], fmt='%1.6f', header='comment')
+    np.testing.assert_array_equal(read_columns(in_file,
+                                               cache_dir=str(cache_dir)),
+                                  expected[:10])
+    assert len(cache_dir.listdir()) == 1
+
+    # files sharing a basename, size and mtime or a name prefix keep their
+    # own caches
+    with open(in_file) as f:
+        text = f.read().replace('1', '2')
+    for other in [str(tmpdir.mkdir('other').join('soil.txt')),
+                  str(tmpdir.join('soil.txt.bak'))]:
+        with open(other, 'w') as f:
+            f.write(text)
+        os.utime(other, (os.path.getatime(in_file),
+                         os.path.getmtime(in_file)))
+        np.testing.assert_array_equal(read_columns(other,
+                                                   cache_dir=str(cache_dir)),
+                                      np.loadtxt(other))
+    assert len(cache_dir.listdir()) == 3
+    np.testing.assert_array_equal(read_columns(in_file,
+                                               cache_dir=str(cache_dir)),
+                                  expected[:10])
+
+    # names with glob characters replace only their own stale caches
+    glob_dir = tmpdir.mkdir('glob')
+    glob_cache = tmpdir.mkdir('glob_cache')
+    for name in ['soil[1].txt', 'soil1.txt']:
+        np.savetxt(str(glob_dir.join(name)), data[:5], fmt='%1.6f')
+        read_columns(str(glob_dir.join(name)), cache_dir=str(glob_cache))
+    np.savetxt(str(glob_dir.join('soil[1].txt')), data[:3], fmt='%1.6f')
+    read_columns(str(glob_dir.join('soil[1].txt')),
+                 cache_dir=str(glob_cache))
+    cached = sorted(f.basename for f in glob_cache.listdir())
+    assert len(cached) == 2
+    assert cached[0].startswith('soil1.txt.')
+    assert np.load(str(glob_cache.join(cached[1]))).shape == (3, 7)
+
+    with open(in_file, 'a') as f:
+        f.write('1 2 3\n')
+    with pytest.raises(ValueError):
+        read_columns(in_file)
+
+    # a row starting with a token that isn't a number is not dropped, and
+    # nothing is cached
+    lines = ['{0} 2 3'.format(i) for i in range(6)]
+    lines[3] = 'x 2 3'
+    bad_file = str(tmpdir.join('bad.txt'))
+    with open(bad_file, 'w') as f:
+        f.write('\n'.join(lines))
+    bad_cache = tmpdir.mkdir('bad_cache')
+    with pytest.raises(ValueError):
+        read_columns(bad_file, cache_dir=str(bad_cache))
+    assert not bad_cache.listdir()
+
+    # blank lines are skipped
+    with open(bad_file, 'w') as f:
+        f.write('1 2 3\n\n4 5 6\n')
+    np.testing.assert_array_equal(read_columns(bad_file),
+                                  [[1, 2, 3], [4, 5, 6]])
+
+
+def test_soil_views(tmpdir):
+    from grid_params import soil
+    data = np.random.RandomState(0).rand(4, 53).round(6)
+    in_file = str(tmpdir.join('soil.txt'))
+    np.savetxt(in_file, data, fmt='%1.6f')
+    soil_dict = soil(in_file)
+    assert soil_dict['lats'].shape == (4, )
+    assert soil_dict['expt'].shape == (4, 3)
+    base = soil_dict['lats'].base
+    assert all(v.base is base for v in soil_dict.values())
+    np.testing.assert_allclose(soil_dict['Ksat'], data[:, 12:15])
+    np.testing.assert_allclose(soil_dict['fs_active'], data[:, 52])
+
+
+def test_veg_parse(tmpdir):
+    from grid_params import veg
+    lai = ['    ' + ' '.join([str(v)] * 12) + '\n' for v in [1.5, 2.5, 0.5]]
+    lines = ['10 2\n',
+             '    1 0.25 0.1 0.7 0.5 0.3 1.0 0.0\n', lai[0],
+             '    7 0.75 0.2 0.6 0.6 0.4 1.5 0.0\n', lai[1],
+             '11 0\n',
+             '\n',
+             '12 1\n',
+             '    11 1.0 0.3 0.5 0.7 0.5 2.0 0.0\n', lai[2]]
+    in_file = tmpdir.join('veg.txt')
+    in_file.write(''.join(lines))
+    veg_dict = veg(str(in_file), None, LAIindex=True)
+    np.testing.assert_array_equal(veg_dict['gridcell'], [10, 11, 12])
+    np.testing.assert_array_equal(veg_dict['Nveg'], [2, 0, 1])
+    np.testing.assert_array_equal(veg_dict['Cv'][:, [0, 6, 10]],
+                                  [[0.25, 0.75, 0], [0, 0, 0], [0, 0, 1]])
+    np.testing.assert_array_equal(veg_dict['root_depth'][0, 0],
+                                  [0.1, 0.5, 1.0])
+    np.testing.assert_array_equal(veg_dict['root_fract'][2, 10],
+                                  [0.5, 0.5, 0.0])
+    np.testing.assert_array_equal(veg_dict['LAI'][0, [0, 6]], [[1.5] * 12,
+                                                               [2.5] * 12])
+    np.testing.assert_array_equal(veg_dict['LAI'][1], 0)
+    np.testing.assert_array_equal(veg_dict['LAI'][2, 10], 0.5)
+
+    # only the first cells records
+    for cells, expected in [(1, [10]), (2, [10, 11]), (5, [10, 11, 12])]:
+        veg_dict = veg(str(in_file), None, cells=cells, LAIindex=True)
+        np.testing.assert_array_equal(veg_dict['gridcell'], expected)
+        assert veg_dict['Cv'].shape == (len(expected), 11)
+        assert veg_dict['LAI'].shape == (len(expected), 11, 12)
+
+    # without LAI lines
+    in_file.write(''.join(l for l in lines if l not in lai))
+    veg_dict = veg(str(in_file), None)
+    assert 'LAI' not in veg_dict
+    np.testing.assert_array_equal(veg_dict['Cv'][0, [0, 6]], [0.25, 0.75])
+
+    # ragged lines that still add up to the expected number of values
+    ragged = list(lines)
+    ragged[3] = '    7 0.75 0.2 0.6 0.6 0.4\n'
+    ragged[8] = '    11 1.0 0.3 0.5 0.7 0.5 2.0 0.0 1.0 0.0\n'
+    in_file.write(''.join(ragged))
+    with pytest.raises(ValueError):
+        veg(str(in_file), None, LAIindex=True)
+
+    # lines after the first cells records are not read
+    ragged = list(lines)
+    ragged[8] = '    11 1.0 0.3 0.5\n'
+    in_file.write(''.join(ragged))
+    with pytest.raises(ValueError):
+        veg(str(in_file), None, LAIindex=True)
+    veg_dict = veg(str(in_file), None, cells=2, LAIindex=True)
+    np.testing.assert_array_equal(veg_dict['gridcell'], [10, 11])
+
+
+def test_align_records(capsys):
+    from grid_params import align_records
+    target = np.array([5, 3, 9, 7])
+    cells = np.array([7, 3, 8, 5, 3])
+    indexes, found = align_records(target, cells, 'snow')
+    np.testing.assert_array_equal(found, [True, True, False, True])
+    np.testing.assert_array_equal(cells[indexes[found]], [5, 3, 7])
+    assert indexes[1] == 1
+    out = capsys.readouterr()[0]
+    assert '1 gridcells have no snow record' in out
+    assert '1 gridcells have more than one snow record' in out
+    assert '1 gridcells in the snow records are not in the soil' in out
+
+    indexes, found = align_records(target, np.array([]), 'veg')
+    assert not found.any()
+
+
+def test_veg(tmpdir):
+    from grid_params import veg
+    in_file = tmpdir.join('veg.txt')
+    in_file.write('10 2\n'
+                  '    1 0.25 0.1 0.7 0.5 0.3 1.0 0.0\n'
+                  '    ' + ' '.join(['1.5'] * 12) + '\n'
+                  '    7 0.75 0.2 0.6 0.6 0.4 1.5 0.0\n'
+                  '    ' + ' '.join(['2.5'] * 12) + '\n'
+                  '11 0\n'
+                  '12 1\n'
+                  '    11 1.0 0.3 0.5 0.7 0.5 2.0 0.0\n'
+                  '    ' + ' '.join(['0.5'] * 12) + '\n')
+    soil_dict = {'gridcell': np.array([12, 10, 11, 13])}
+    veg_dict = veg(str(in_file), soil_dict, LAIindex=True)
+    np.testing.assert_array_equal(veg_dict['gridcell'], [12, 10, 11, 13])
+    np.testing.assert_array_equal(veg_dict['Nveg'], [1, 2, 0, 0])
+    assert veg_dict['Cv'].shape == (4, 11)
+    np.testing.assert_array_equal(veg_dict['Cv'].sum(axis=1), [1, 1, 0, 0])
+    assert veg_dict['Cv'][1, 6] == 0.75
+    np.testing.assert_array_equal(veg_dict['root_depth'][1, 6],
+                                  [0.2, 0.6, 1.5])
+    np.testing.assert_array_equal(veg_dict['root_fract'][0, 10],
+                                  [0.5, 0.5, 0.0])
+    np.testing.assert_array_equal(veg_dict['LAI'][1, 0], 1.5)
+    np.testing.assert_array_equal(veg_dict['LAI'][2:], 0)
+
+    veg_dict = veg(str(in_file), {'gridcell': np.array([13])},
+                   LAIindex=True)
+    assert veg_dict['gridcell'] == 13 and veg_dict['Cv'].shape == (11, )
+
+    in_file.write('10 1\n    1 0.25 0.1 0.7\n')
+    with pytest.raises(ValueError):
+        veg(str(in_file), soil_dict, LAIindex=True)
+
+
+def test_grid_variable():
+    from grid_params import grid_variable, FILLVALUE_F, FILLVALUE_I
+    ocean = np.array([[False, True, False], [True, False, False]])
+    yi = np.array([1, 0, 1])
+    xi = np.array([2, 0, 1])
+    data = np.arange(3 * 2 * 4, dtype=float).reshape(3, 2, 4)
+    data[2, 1, 3] = FILLVALUE_F
+    grid = grid_variable(data, yi, xi, ocean)
+    assert grid.shape == (2, 4, 2, 3)
+    np.testing.assert_array_equal(grid[..., 1, 2], data[0])
+    np.testing.assert_array_equal(grid[..., 0, 0], data[1])
+    assert grid.mask[..., ocean].all()
+    assert grid.mask[1, 3, 1, 1] and grid.mask.sum() == 2 * 4 * 2 + 1
+    assert grid[0, 0, 0, 2] == 0 and not grid.mask[0, 0, 0, 2]
+
+    grid = grid_variable(np.array([4, 5, 6]), yi, xi, ocean)
+    assert grid.dtype == np.int and grid.fill_value == FILLVALUE_I
+    np.testing.assert_array_equal(grid.filled(), [[5, FILLVALUE_I, 0],
+                                                  [FILLVALUE_I, 6, 4]])
+
+
+def test_write_netcdf_stream(tmpdir):
+    from grid_params import write_netcdf, FILLVALUE_F
+    from netCDF4 import Dataset
+    target_grid = {'xc': np.arange(4.), 'yc': np.arange(3.),
+                   'mask': np.ones((3, 4))}
+    target_attrs = {'xc': {}, 'yc': {}, 'mask': {}}
+    elev = np.ma.masked_equal(np.arange(12.).reshape(3, 4), 5)
+    depth = np.ones((3, 3, 4))
+    lai = np.ma.masked_array(np.ones((2, 12, 3, 4)), fill_value=FILLVALUE_F)
+
+    def grids():
+        yield 'soil_dict', 'elev', elev
+        yield 'soil_dict', 'depth', depth
+        yield 'veg_dict', 'gridcell', elev
+        yield 'veg_dict', 'LAI', lai
+
+    nc_file = str(tmpdir.join('params.nc'))
+    write_netcdf(nc_file, target_attrs, target_grid, grids=grids(),
+                 var_types={'LAI': 'f4'}, zlib=True, chunks=(2, 10))
+    f = Dataset(nc_file)
+    assert 'gridcell' not in f.variables
+    assert f.variables['elev'].dtype == np.float64
+    assert f.variables['elev'][:].mask.sum() == 1
+    assert f.variables['depth'].dimensions == ('nlayer', 'lat', 'lon')
+    assert f.variables['LAI'].dtype == np.float32
+    assert f.variables['LAI'].dimensions == ('veg_class', 'month', 'lat',
+                                             'lon')
+    assert f.variables['LAI'].chunking() == [1, 1, 2, 4]
+    assert f.variables['LAI'].filters()['zlib']
+    np.testing.assert_array_equal(f.variables['month'][:], np.arange(1, 13))
+    f.close()
+
+
+def test_vic5_veg_grids():
+    from grid_params import add_bare_soil, BroadcastGrid
+    ocean = np.array([[False, True], [False, False]])
+    cv = np.ma.masked_array(np.zeros((2, 2, 2)),
+                            mask=np.array([ocean, ocean]))
+    cv[:, 0, 0] = [0.5, 0.25]
+    cv[:, 1, 0] = [0.75, 0.75]
+    new = add_bare_soil('Cv', cv, ocean)
+    assert new.shape == (3, 2, 2)
+    np.testing.assert_allclose(new[:, 0, 0], [0.5, 0.25, 0.25])
+    np.testing.assert_allclose(new[:, 1, 0], [0.5, 0.5, 0.])
+    np.testing.assert_allclose(new[:, 1, 1], [0., 0., 1.])
+    assert new.mask[:, 0, 1].all() and new.mask.sum() == 3
+
+    land = ~ocean
+    land[1, 1] = False
+    grid = BroadcastGrid(np.array([[1., 2.], [3., 4.], [0., 0.]]), land)
+    assert grid.shape == (3, 2, 2, 2) and grid.ndim == 4
+    np.testing.assert_array_equal(grid[1, 0].filled(-1), [[3, -1], [3, -1]])
+    assert grid[:].mask.sum() == 3 * 2 * 2
+
+
+def test_read_parallel(tmpdir):
+    from grid_params import read_parallel, soil
+    data = np.random.RandomState(0).rand(4, 53).round(6)
+    in_file = str(tmpdir.join('soil.txt'))
+    np.savetxt(in_file, data, fmt='%1.6f')
+    jobs = {'soil': (soil, (in_file, ), {}),
+            'layers': (soil, (in_file, ), {'nlayers': 2})}
+    dicts = read_parallel(jobs, 2, tmp_dir=str(tmpdir))
+    assert list(dicts['soil']) == list(soil(in_file))
+    np.testing.assert_array_equal(dicts['soil']['expt'], data[:, 9:12])
+    np.testing.assert_array_equal(dicts['layers']['expt'], data[:, 9:11])
+    assert tmpdir.listdir() == [tmpdir.join('soil.txt')]
+
+    jobs['missing'] = (soil, (str(tmpdir.join('missing.txt')), ), {})
+    with pytest.raises((IOError, OSError)):
+        read_parallel(jobs, 2, tmp_dir=str(tmpdir))
+    assert tmpdir.listdir() == [tmpdir.join('soil.txt')]
+
+
+def test_var_type_option(monkeypatch):
+    from grid_params import process_command_line
+    argv = ['grid_params.py', '-s', 'soil.txt', '--var_type', 'LAI=f4',
+            '--var_type', 'Nveg=i4']
+    monkeypatch.setattr(sys, 'argv', argv)
+    nc_options = process_command_line()[-1]
+    assert nc_options['var_types'] == {'LAI': 'f4', 'Nveg': 'i4'}
+
+    for var_type in ['LAI', 'LAI=float32', '=f4', 'LAI=f4=f8']:
+        monkeypatch.setattr(sys, 'argv', argv[:3] + ['--var_type', var_type])
+        with pytest.raises(SystemExit):
+            process_command_line()
+
+# -------------------------------------------------------------------- #
@@ -0,0 +1,267 @@
+#!/usr/local/env python
+"""
+test_netcdf2vic.py
+
+Set to run with pytest
+
+Usage: py.test (from VICpy or test directory)
+"""
+import os
+import struct
+import sys
+import pytest
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'forcing_tools'))
+
+# -------------------------------------------------------------------- #
+# Unit tests for netcdf2vic.py
+
+
+def test_binary_dtype_matches_struct():
+    from netcdf2vic import binary_dtype, pack_binary
+    data = np.array([[1., 2., 3., 4.], [40., -50., 60., -70.]])
+    for binary_type in ['Hhhh', '<Hhhh', '>Hhhh', 'Hihd', '=Hh2h']:
+        records, clipped = pack_binary(data, binary_dtype(binary_type))
+        expected = b''.join(struct.pack(binary_type, *map(int, row))
+                            for row in data)
+        assert records.tobytes() == expected
+        assert clipped == 0
+
+
+def test_pack_binary_clips():
+    from netcdf2vic import binary_dtype, pack_binary
+    data = np.array([[1.6, 70000.], [-1., np.nan]])
+    records, clipped = pack_binary(data, binary_dtype('Hh'))
+    np.testing.assert_array_equal(records['f0'], [2, 0])
+    np.testing.assert_array_equal(records['f1'], [32767, 0])
+    assert clipped == 3
+
+
+def test_output_manager(tmpdir):
+    from netcdf2vic import OutputManager
+    files = [str(tmpdir.join('f{0}'.format(i))) for i in range(4)]
+    with open(files[0], 'w') as f:
+        f.write('old')
+    out = OutputManager(10, max_open=2)
+    for i in range(3):
+        for fname in files:
+            out.write(fname, 'abc{0}'.format(i), append=(i > 0))
+        assert len(out.handles) <= 2
+        assert out.buffered <= 10
+    out.close()
+    assert not out.handles
+    for fname in files:
+        assert open(fname).read() == 'abc0abc1abc2'
+
+
+def test_cell_cache(tmpdir):
+    from netcdf2vic import (cell_cache_key, read_cell_cache,
+                            write_cell_cache)
+    mask_file = tmpdir.join('mask.nc')
+    nc_file = tmpdir.join('forcing.nc')
+    mask_file.write('mask')
+    nc_file.write('data')
+    cache_file = str(tmpdir.join('cells.npz'))
+    key = cell_cache_key(str(mask_file), str(nc_file), ['prcp', 'tas'])
+    assert read_cell_cache(cache_file, key) is None
+
+    points = [(45.0625, -120.5625), (45.125, -120.5)]
+    write_cell_cache(cache_file, key, np.array([0, 1]), np.array([2, 3]),
+                     points)
+    ylist, xlist, pointlist = read_cell_cache(cache_file, key)
+    np.testing.assert_array_equal(ylist, [0, 1])
+    np.testing.assert_array_equal(xlist, [2, 3])
+    assert pointlist == points
+
+    key = cell_cache_key(str(mask_file), str(nc_file), ['prcp'])
+    assert read_cell_cache(cache_file, key) is None
+
+
+def test_format_ascii_matches_savetxt():
+    from cStringIO import StringIO
+    from netcdf2vic import format_ascii
+    rs = np.random.RandomState(0)
+    arrays = [rs.randn(200, 7) * 10 ** rs.uniform(-6, 12, (200, 7)),
+              np.round(rs.randn(200, 3) * 100, 4) + 0.00005,
+              np.arange(-2000, 2000).reshape(-1, 4) / 32.,
+              np.array([[0., -0., -1e-9, np.nan, np.inf, -np.inf, 1e300,
+                         9.99995, 999999.99995]]),
+              rs.randn(20).astype(np.float32),
+              np.zeros((0, 3))]
+    for array in arrays:
+        s = StringIO()
+        np.savetxt(s, array, fmt='%1.4f')
+        assert format_ascii(array) == s.getvalue()
+
+
+def test_parse_date():
+    from datetime import datetime
+    from netcdf2vic import parse_date
+    assert parse_date('2000-06-01') == datetime(2000, 6, 1)
+    assert parse_date('2000-06-01', end=True) == datetime(2000, 6, 1, 23,
+                                                          59, 59)
+    assert parse_date('2000-06-01 06', end=True) == datetime(2000, 6, 1, 6)
+    assert parse_date(' 2000-06-01 06:30:15') == datetime(2000, 6, 1, 6, 30,
+                                                          15)
+    with pytest.raises(ValueError):
+        parse_date('06/01/2000')
+
+
+def test_prefetch():
+    from netcdf2vic import prefetch
+
+    def items():
+        for i in range(10):
+            yield i
+        raise IOError('bad file')
+
+    for depth in [0, 1, 3]:
+        result = []
+        with pytest.raises(IOError):
+            for item in prefetch(items(), depth):
+                result.append(item)
+        assert result == range(10)
+
+
+def test_multi_file_dataset(tmpdir):
+    from netCDF4 import Dataset
+    from netcdf2vic import MultiFileDataset
+    data = np.arange(20 * 2 * 3, dtype=np.float32).reshape(20, 2, 3)
+    paths = []
+    for i, (t0, t1) in enumerate([(0, 6), (6, 7), (7, 20)]):
+        paths.append(str(tmpdir.join('in_{0}.nc'.format(i))))
+        f = Dataset(paths[-1], 'w')
+        f.createDimension('time', None)
+        f.createDimension('y', 2)
+        f.createDimension('x', 3)
+        f.createVariable('prcp', 'f4', ('time', 'y', 'x'))[:] = data[t0:t1]
+        f.close()
+
+    mf = MultiFileDataset(paths, max_open=1)
+    var = mf.variables['prcp']
+    assert var.shape == data.shape
+    np.testing.assert_array_equal(var[:], data)
+    np.testing.assert_array_equal(var[4:9, 1, 0:2], data[4:9, 1, 0:2])
+    np.testing.assert_array_equal(var[2:18:5], data[2:18:5])
+    np.testing.assert_array_equal(var[-1], data[-1])
+    assert var[8:8].shape == (0, 2, 3)
+    assert len(mf.handles) == 1
+    mf.close()
+
+    mf = MultiFileDataset(paths, time_slices=[slice(2, 6), slice(None),
+                                              slice(0, 3)])
+    expected = np.concatenate([data[2:6], data[6:7], data[7:10]])
+    assert len(mf.variables['prcp']) == 8
+    np.testing.assert_array_equal(mf.variables['prcp'][:, 0, 2],
+                                  expected[:, 0, 2])
+    with pytest.raises(IndexError):
+        mf.variables['prcp'][8]
+    mf.close()
+
+
+def test_read_blocks_per_file(tmpdir):
+    from netCDF4 import Dataset
+    from netcdf2vic import MultiFileDataset, read_blocks
+    data = np.arange(20 * 2 * 3, dtype=np.float32).reshape(20, 2, 3)
+    paths = []
+    for i, (t0, t1) in enumerate([(0, 6), (6, 7), (7, 20)]):
+        paths.append(str(tmpdir.join('in_{0}.nc'.format(i))))
+        f = Dataset(paths[-1], 'w')
+        f.createDimension('time', None)
+        f.createDimension('y', 2)
+        f.createDimension('x', 3)
+        for key in ['prcp', 'tas']:
+            f.createVariable(key, 'f4', ('time', 'y', 'x'))[:] = \
+                data[t0:t1] * (1 if key == 'prcp' else -1)
+        f.close()
+
+    mf = MultiFileDataset(paths)
+    ylist, xlist = np.array([0, 1, 1]), np.array([1, 0, 2])
+    # a whole row of the longest file fits, tiles of shorter files are larger
+    budget = 13 * 2 * 17 * 3
+    result = np.zeros((2, 3, 20, 2))
+    spans = []
+    for tile, steps, block in read_blocks(mf, ['prcp', 'tas'], ylist, xlist,
+                                          budget):
+        result[tile + (steps, )] = block
+        spans.append((steps.start, steps.stop, tile[0].stop - tile[0].start))
+    assert spans == [(0, 6, 2), (6, 7, 2), (7, 20, 1), (7, 20, 1)]
+    np.testing.assert_array_equal(result[..., 0], np.rollaxis(data, 0, 3))
+    np.testing.assert_array_equal(result[..., 1], -np.rollaxis(data, 0, 3))
+
+    # a time slice of one file
+    blocks = list(read_blocks(mf, ['prcp'], ylist, xlist, budget,
+                              time_slice=slice(8, 12)))
+    assert [b[1] for b in blocks] == [slice(0, 4)]
+    np.testing.assert_array_equal(blocks[0][2][..., 0],
+                                  np.rollaxis(data[8:12], 0, 3))
+    mf.close()
+
+
+def test_image_writer(tmpdir):
+    from netCDF4 import Dataset
+    from netcdf2vic import MultiFileDataset, ImageWriter, get_tiles, \
+        read_blocks
+    lats = np.array([40.25, 40.75, 41.25])
+    lons = np.arange(240.25, 243, 0.5)
+    data = np.random.RandomState(0).rand(549, 3, 6).astype(np.float32)
+    # daily steps from 2000-07-01, split in two files at 2001-03-01
+    paths = []
+    for i, (t0, t1) in enumerate([(0, 243), (243, 549)]):
+        paths.append(str(tmpdir.join('in_{0}.nc'.format(i))))
+        f = Dataset(paths[-1], 'w')
+        f.createDimension('time', None)
+        f.createDimension('y', 3)
+        f.createDimension('x', 6)
+        time = f.createVariable('time', 'f8', ('time', ))
+        time.units = 'days since 2000-07-01'
+        time[:] = np.arange(t0, t1)
+        xc, yc = np.meshgrid(lons, lats)
+        f.createVariable('xc', 'f8', ('y', 'x'))[:] = xc
+        f.createVariable('yc', 'f8', ('y', 'x'))[:] = yc
+        for key, sign in [('prcp', 1), ('tas', -1)]:
+            var = f.createVariable(key, 'f4', ('time', 'y', 'x'))
+            var.units = key
+            var[:] = sign * data[t0:t1]
+        f.close()
+
+    ylist, xlist = np.array([0, 1, 1, 2]), np.array([1, 2, 3, 4])
+    var_keys = ['prcp', 'tas']
+    mf = MultiFileDataset(paths)
+    image = ImageWriter(mf, var_keys, ylist, xlist, str(tmpdir), 'out_',
+                        chunks=(30, 1, 2))
+    budget = 17 * 2 * 306 * 3
+    # 3 cells of the second file fit, tiles hold whole x chunks
+    tiles = get_tiles(mf, var_keys, ylist, xlist, budget,
+                      time_slice=slice(243, 549), align=(1, 2))
+    assert [(t[1].start, t[1].stop) for t in tiles] == [(0, 2), (2, 4),
+                                                         (4, 6)] * 3
+    for tile, steps, block in read_blocks(mf, var_keys, ylist, xlist,
+                                          budget, align=image.chunks[1:]):
+        image.write_block(tile, steps, block)
+    image.close()
+    mf.close()
+
+    active = np.zeros((3, 6), dtype=bool)
+    active[ylist, xlist] = True
+    for year, (t0, t1) in [(2000, (0, 184)), (2001, (184, 549))]:
+        f = Dataset(str(tmpdir.join('out_{0}.nc'.format(year))))
+        np.testing.assert_array_equal(f.variables['lat'][:], lats)
+        np.testing.assert_array_equal(f.variables['lon'][:], lons - 360)
+        np.testing.assert_array_equal(f.variables['time'][:],
+                                      np.arange(t0, t1))
+        for key, sign in [('prcp', 1), ('tas', -1)]:
+            var = f.variables[key]
+            assert var.chunking() == [30, 1, 2]
+            assert var.units == key
+            values = var[:]
+            mask = np.ma.getmaskarray(values)
+            assert values.shape == (t1 - t0, 3, 6)
+            assert (mask == ~active).all()
+            np.testing.assert_array_equal(values[:, active],
+                                          sign * data[t0:t1, active])
+            var.set_auto_mask(False)
+            assert (var[:][:, ~active] == var._FillValue).all()
+        f.close()
+
+# -------------------------------------------------------------------- #
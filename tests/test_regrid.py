@@ -0,0 +1,126 @@
+#!/usr/local/env python
+"""
+test_regrid.py
+
+Set to run with pytest
+
+Usage: py.test (from VICpy or test directory)
+"""
+import os
+import sys
+import pytest
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'forcing_tools'))
+
+# -------------------------------------------------------------------- #
+# Unit tests for regrid.py
+
+
+def cell_corners(lat_edges, lon_edges):
+    """corners (ny, nx, 4) of the cells between lat_edges and lon_edges"""
+    lon0, lat0 = np.meshgrid(lon_edges[:-1], lat_edges[:-1])
+    lon1, lat1 = np.meshgrid(lon_edges[1:], lat_edges[1:])
+    yv = np.dstack((lat0, lat0, lat1, lat1))
+    xv = np.dstack((lon0, lon1, lon1, lon0))
+    return yv, xv
+
+
+def test_bilinear_linear_field():
+    from regrid import bilinear_weights
+    src_lats = np.arange(30.25, 40, 0.5)
+    src_lons = np.arange(-120.25, -100, 0.5)[::-1]
+    lon, lat = np.meshgrid(src_lons, src_lats)
+    field = 2 * lat + 3 * lon
+
+    dst_lats = np.array([[31.1, 35.3], [39.74, 30.25]])
+    dst_lons = np.array([[-110.2, 239.9], [-101.0, -120.0]])
+    weights = bilinear_weights(src_lats, src_lons, dst_lats, dst_lons)
+    expected = 2 * dst_lats + 3 * np.where(dst_lons > 180, dst_lons - 360,
+                                           dst_lons)
+    np.testing.assert_allclose(weights.dot(field.ravel()),
+                               expected.ravel())
+
+    # outside the source grid
+    weights = bilinear_weights(src_lats, src_lons, [50.], [-110.])
+    assert weights.nnz == 0
+
+
+def test_bilinear_global_wrap():
+    from regrid import bilinear_weights
+    src_lats = np.arange(-89.75, 90, 0.5)
+    src_lons = np.arange(-179.75, 180, 0.5)
+    weights = bilinear_weights(src_lats, src_lons, [10.25, 10.25],
+                               [179.9, -179.9 + 360])
+    lon, lat = np.meshgrid(src_lons, src_lats)
+    field = np.cos(np.radians(lon))
+    result = weights.dot(field.ravel())
+    np.testing.assert_allclose(result, np.cos(np.radians(179.75)))
+
+
+def test_conservative_weights():
+    from regrid import conservative_weights
+    src_lats = np.arange(40.25, 44, 0.5)
+    src_lons = np.arange(0.25, 360, 0.5)
+    nsrc = len(src_lats) * len(src_lons)
+
+    # the source grid itself
+    yv, xv = cell_corners(np.arange(40, 44.1, 0.5), np.arange(0, 360.1, 0.5))
+    lon, lat = np.meshgrid(src_lons, src_lats)
+    weights = conservative_weights(src_lats, src_lons, lat, lon, yv, xv)
+    np.testing.assert_allclose(weights.toarray(), np.eye(nsrc), atol=1e-12)
+
+    # 1 x 1 degree cells, crossing the 0 meridian
+    lat_edges = np.arange(40, 44.1, 1.)
+    lon_edges = np.arange(-10, 10.1, 1.)
+    yv, xv = cell_corners(lat_edges, lon_edges)
+    lon, lat = np.meshgrid(lon_edges[:-1] + 0.5, lat_edges[:-1] + 0.5)
+    weights = conservative_weights(src_lats, src_lons, lat, lon, yv, xv)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    assert (weights.getnnz(axis=1) == 4).all()
+
+    # area weighted, the total is conserved
+    src_area = np.diff(np.sin(np.radians(np.arange(40, 44.1, 0.5))))
+    field = np.random.RandomState(0).rand(len(src_lats), len(src_lons))
+    dst_area = np.diff(np.sin(np.radians(lat_edges)))
+    result = weights.dot(field.ravel()).reshape(lat.shape)
+    src = np.hstack((field[:, -20:], field[:, :20]))
+    np.testing.assert_allclose(
+        (result * dst_area[:, None]).sum() * 2,
+        (src * src_area[:, None]).sum())
+
+
+def test_remap_masked():
+    from regrid import remap
+    from scipy import sparse
+    weights = sparse.csr_matrix(np.array([[0.5, 0.5, 0], [0, 0, 1.]]))
+    data = np.ma.masked_array([[[1., 3., 5.]], [[2., 4., 6.]]],
+                              mask=[[[0, 1, 0]], [[0, 0, 1]]])
+    result = remap(weights, data, (2, 1))
+    assert result.shape == (2, 2, 1)
+    np.testing.assert_allclose(result[:, 0, 0], [1., 3.])
+    np.testing.assert_array_equal(np.ma.getmaskarray(result[:, 1, 0]),
+                                  [False, True])
+    assert result[0, 1, 0] == 5.
+
+
+def test_get_weights_cache(tmpdir):
+    import regrid
+    src_lats = np.arange(40.25, 42, 0.5)
+    src_lons = np.arange(-110.25, -108, 0.5)
+    dst = {'lat': np.array([[40.6]]), 'lon': np.array([[-109.6]]),
+           'lat_bounds': None, 'lon_bounds': None}
+    weights = regrid.get_weights('bilinear', src_lats, src_lons, dst,
+                                 cache_dir=str(tmpdir))
+    files = os.listdir(str(tmpdir))
+    assert len(files) == 1 and files[0].startswith('weights_bilinear_')
+
+    regrid._WEIGHTS.clear()
+    cached = regrid.get_weights('bilinear', src_lats, src_lons, dst,
+                                cache_dir=str(tmpdir))
+    assert (cached != weights).nnz == 0
+    with pytest.raises(ValueError):
+        regrid.get_weights('conservative', src_lats, src_lons, dst)
+    with pytest.raises(ValueError):
+        regrid.get_weights('remapnn', src_lats, src_lons, dst)
+
+# -------------------------------------------------------------------- #
@@ -6,6 +6,7 @@ Set to run with pytest
 
 Usage: py.test (from RVIC or test directory)
 """
+import os
 import pytest
 import numpy as np
 import sys
@@ -25,6 +26,128 @@ def test_calc_grid_standard():
     lats = np.arange(0, 10, 0.5)
     target_grid = calc_grid(lons, lats, decimals=4)
 
+
+def test_segment_layouts(tmpdir):
+    from processing_tools.vic2netcdf import Segment, Point
+    point = Point(lat=45.25, lon=-120.75, y=2, x=3, cell=5)
+    dims = {'grid': (('time', 'y', 'x'), (slice(None), 2, 3)),
+            'transposed': (('y', 'x', 'time'), (2, 3, slice(None))),
+            'station': (('cell', 'time'), (5, slice(None)))}
+    for layout, (expected_dims, expected_index) in dims.items():
+        filename = str(tmpdir.join('{0}.nc'.format(layout)))
+        segment = Segment(0, 0, 10, 'NETCDF4', filename, layout=layout)
+        assert segment.field_dims(['y', 'x']) == expected_dims
+        assert segment.field_index(point) == expected_index
+        assert 'soil_layers' in segment.field_dims(['y', 'x'], 'soil_layers')
+        segment.nc_close()
+
+
+def test_expand_gathered():
+    from processing_tools.vic2netcdf import expand_gathered
+    data = np.arange(6.).reshape(2, 3)
+    full = expand_gathered(data, [0, 4, 5], (2, 3))
+    assert full.shape == (2, 2, 3)
+    np.testing.assert_array_equal(full[:, 0, 0], data[:, 0])
+    np.testing.assert_array_equal(full[:, 1, 1], data[:, 1])
+    np.testing.assert_array_equal(full[:, 1, 2], data[:, 2])
+    assert full.mask.sum() == 6
+
+
+def test_pack_params():
+    from processing_tools.vic2netcdf import pack_params, packed_range
+    assert pack_params({'pack_range': [0, 10]}, 'f4') is None
+    assert pack_params({'scale_factor': 0.1}, 'i2') == (0.1, 0.0)
+    scale_factor, add_offset = pack_params({'pack_range': [-5, 10]}, 'i2')
+    imin, imax = packed_range('i2')
+    np.testing.assert_allclose(imin * scale_factor + add_offset, -5)
+    np.testing.assert_allclose(imax * scale_factor + add_offset, 10)
+
+
+def test_time_chunksize():
+    from processing_tools.vic2netcdf import time_chunksize
+    assert time_chunksize([0, 744, 1416, 2160]) == 24
+    assert time_chunksize([0, 31, 60]) == 1
+    assert time_chunksize([0]) == 1
+
+
+def test_zarr_segments(tmpdir):
+    pytest.importorskip('zarr')
+    from processing_tools.vic2netcdf import Segment
+    store = str(tmpdir.join('test.zarr'))
+    times = np.arange(10.)
+
+    def define(segment):
+        segment.nc_globals(history='test', project='zarr')
+        segment.f.createDimension('time', segment.i1 - segment.i0)
+        segment.f.createDimension('y', 2)
+        segment.f.createVariable('y', 'f8', ('y', ))[:] = [5., 6.]
+        var = segment.f.createVariable('data', 'f4', ('time', 'y'),
+                                       fill_value=-1.)
+        var.units = 'mm'
+        return var
+
+    # the store and its metadata are created once
+    segment = Segment(0, 0, 10, 'ZARR', store,
+                      backend_kwargs={'time_size': 10, 'time_chunk': 2,
+                                      'create': True})
+    define(segment)
+    segment.nc_close()
+
+    for i0, i1 in [(0, 4), (4, 10)]:
+        segment = Segment(0, i0, i1, 'ZARR', store,
+                          backend_kwargs={'time_size': 10, 'time_chunk': 2})
+        assert segment.append
+        var = define(segment)
+        assert var.shape == (i1 - i0, 2)
+        var[:, 1] = times[i0:i1]
+        segment.nc_close()
+    import zarr
+    group = zarr.open_group(store, mode='r')
+    data = group['data']
+    np.testing.assert_array_equal(data[:, 1], times)
+    np.testing.assert_array_equal(data[:, 0], -1.)
+    np.testing.assert_array_equal(group['y'][:], [5., 6.])
+    assert data.attrs['_ARRAY_DIMENSIONS'] == ['time', 'y']
+    assert data.attrs['units'] == 'mm'
+    assert group.attrs['project'] == 'zarr'
+    assert not [a for a in group.attrs if a.startswith('g_')]
+    assert os.listdir(str(tmpdir)) == ['test.zarr']
+
+    # a segment with other chunks can't write to the store
+    segment = Segment(0, 0, 5, 'ZARR', store,
+                      backend_kwargs={'time_size': 10, 'time_chunk': 5})
+    with pytest.raises(ValueError):
+        define(segment)
+
+
+def test_ascii_stream_blocks(tmpdir):
+    from processing_tools.vic2netcdf import Plist, Point
+    data = np.arange(50.).reshape(10, 5)
+    filename = str(tmpdir.join('fluxes_45.25_-120.75'))
+    np.savetxt(filename, data, fmt='%1.4f', delimiter='\t')
+
+    points = Plist([Point(filename=filename)])
+    points.set_names(['a', 'b'])
+    points.set_usecols([1, 3])
+    points.set_block_size(3)
+    points.set_fileformat('ascii', stream=True)
+    point = points[0]
+    point.open()
+    for i0, i1 in [(0, 4), (4, 5), (5, 10)]:
+        point.read(i1 - i0)
+        np.testing.assert_array_equal(point.get_values('a'), data[i0:i1, 1])
+        np.testing.assert_array_equal(point.get_values('b'), data[i0:i1, 3])
+    with pytest.raises(ValueError):
+        point.read(1)
+    point.close()
+
+
+def test_segment_unknown_layout(tmpdir):
+    from processing_tools.vic2netcdf import Segment
+    with pytest.raises(ValueError):
+        Segment(0, 0, 10, 'NETCDF4', str(tmpdir.join('bad.nc')),
+                layout='diagonal')
+
 # -------------------------------------------------------------------- #
 
 